@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# (c) 2015 Hector Socas-Navarro (hsocas.iac@gmail.com)
+#
+
+"""
+This module computes summaries of the notes of a song over time bins of
+a given width (in seconds), with numpy and no loop over the notes: piano
+rolls (number of notes sounding in each bin, by pitch, track, channel or
+patch), polyphony, note density, pitch range and instrument activity. A
+note counts in every bin that it overlaps, including the bin where it
+starts even if it is shorter than the bin. Requires: numpy.
+
+The notes may be given as a notetable, a midifile or song object (on
+which load_file() has been run) or a list like midifile.notes. Bin i
+covers the times from i*binwidth to (i+1)*binwidth. The number of bins
+covers duration seconds (by default, the end of the last note).
+
+   active_matrix(notes, binwidth, by='pitch', duration=None,
+     sparse=False): Array with the number of notes sounding in each bin
+     for each value of the field by ('pitch', 'track', 'channel' or
+     'patch'), with shape (values, bins). 128 values are used for pitch
+     and patch, 16 for channel and the highest track number plus one for
+     track. by may also be a list of fields, e.g. ['track', 'pitch'],
+     for an array with one dimension per field and the bins last. If
+     sparse is True, returns instead a list with one array of indices
+     per field, one with the bins and one with the counts of the bins
+     that are not zero (e.g., for scipy.sparse.coo_matrix).
+
+   polyphony(notes, binwidth, duration=None): Array with the number of
+     notes sounding in each bin.
+
+   note_density(notes, binwidth, duration=None): Array with the number
+     of notes that start in each bin.
+
+   pitch_envelope(notes, binwidth, duration=None): Two arrays with the
+     lowest and highest pitch sounding in each bin (-1 if none).
+
+   instrument_activity(notes, binwidth, duration=None): Array of shape
+     (128, bins) with the number of notes of each patch sounding in each
+     bin (same as active_matrix with by='patch').
+
+   nbins(notes, binwidth, duration=None): Number of bins.
+"""
+
+import numpy
+import notetable
+
+SIZES={'pitch':128,'patch':128,'channel':16}
+
+
+def _table(notes):
+    if isinstance(notes,notetable.notetable):
+        return notes
+    if hasattr(notes,'get_notetable'):
+        return notes.get_notetable()
+    return notetable.notetable(notes)
+
+
+def nbins(notes,binwidth,duration=None):
+    table=_table(notes)
+    if duration == None:
+        duration=float(table.toff.max()) if len(table) > 0 else 0.
+    return max(int(numpy.ceil(duration/float(binwidth))),1)
+
+
+def _bins(table,binwidth,n):
+    # First and one past the last bin of each note, within [0,n]
+    start=numpy.floor(table.ton/binwidth).astype(numpy.int64)
+    end=numpy.ceil(table.toff/binwidth).astype(numpy.int64)
+    end=numpy.maximum(end,start+1) # Notes shorter than a bin
+    return [numpy.clip(start,0,n),numpy.clip(end,0,n)]
+
+
+def active_matrix(notes,binwidth,by='pitch',duration=None,sparse=False):
+    table=_table(notes)
+    n=nbins(table,binwidth,duration)
+    fields=[by] if isinstance(by,str) else list(by)
+    shape=list()
+    for field in fields:
+        if field == 'track':
+            shape.append(int(table.track.max())+1 if len(table) > 0 else 1)
+        else:
+            shape.append(SIZES[field])
+    keys=numpy.ravel_multi_index([getattr(table,field).astype(numpy.int64) for field in fields],shape)
+    [start,end]=_bins(table,binwidth,n)
+    if sparse:
+        [key,ibin,counts]=_sparse_counts(keys,start,end)
+        return list(numpy.unravel_index(key,shape))+[ibin,counts]
+    # Each note adds one at its first bin and subtracts one after its
+    # last one. The running sum over the bins gives the notes sounding
+    nkeys=int(numpy.prod(shape))
+    counts=numpy.bincount(keys*(n+1)+start,minlength=nkeys*(n+1))
+    counts-=numpy.bincount(keys*(n+1)+end,minlength=nkeys*(n+1))
+    counts=numpy.cumsum(counts.reshape(nkeys,n+1),axis=1)[:,:n]
+    return counts.reshape(shape+[n])
+
+
+def _sparse_counts(keys,start,end):
+    # Same as the dense count without making the dense array: the steps
+    # (+1 at the start, -1 at the end of each note) are sorted by key and
+    # bin, and each run of bins with the same count is expanded
+    k=numpy.concatenate([keys,keys])
+    b=numpy.concatenate([start,end])
+    d=numpy.concatenate([numpy.ones(len(keys),numpy.int64),-numpy.ones(len(keys),numpy.int64)])
+    order=numpy.lexsort((b,k))
+    [k,b,d]=[k[order],b[order],d[order]]
+    if len(k) == 0:
+        return [k,b,d]
+    first=numpy.flatnonzero(numpy.concatenate([[True],(k[1:] != k[:-1]) | (b[1:] != b[:-1])]))
+    d=numpy.add.reduceat(d,first)
+    k=k[first]
+    b=b[first]
+    # The steps of each key add up to zero, so the running sum is the
+    # count of each key from its step to the next one
+    level=numpy.cumsum(d)
+    length=numpy.concatenate([b[1:]-b[:-1],[0]])
+    keep=(level != 0) & (length > 0)
+    [k,b,level,length]=[k[keep],b[keep],level[keep],length[keep]]
+    runstart=numpy.cumsum(length)-length
+    ibin=numpy.arange(length.sum())-numpy.repeat(runstart,length)+numpy.repeat(b,length)
+    return [numpy.repeat(k,length),ibin,numpy.repeat(level,length)]
+
+
+def polyphony(notes,binwidth,duration=None):
+    table=_table(notes)
+    n=nbins(table,binwidth,duration)
+    [start,end]=_bins(table,binwidth,n)
+    counts=numpy.bincount(start,minlength=n+1)-numpy.bincount(end,minlength=n+1)
+    return numpy.cumsum(counts)[:n]
+
+
+def note_density(notes,binwidth,duration=None):
+    table=_table(notes)
+    n=nbins(table,binwidth,duration)
+    start=numpy.floor(table.ton/binwidth).astype(numpy.int64)
+    return numpy.bincount(start[start < n],minlength=n)
+
+
+def pitch_envelope(notes,binwidth,duration=None):
+    roll=active_matrix(notes,binwidth,'pitch',duration) > 0
+    sounding=roll.any(axis=0)
+    low=numpy.where(sounding,numpy.argmax(roll,axis=0),-1)
+    high=numpy.where(sounding,127-numpy.argmax(roll[::-1],axis=0),-1)
+    return [low,high]
+
+
+def instrument_activity(notes,binwidth,duration=None):
+    return active_matrix(notes,binwidth,'patch',duration)
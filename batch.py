@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# (c) 2015 Hector Socas-Navarro (hsocas.iac@gmail.com)
+#
+
+"""
+This module applies the transformations of midifile.write_variant (remove
+tracks, mute patches, remove channels, cut a time range, transpose, change
+the tempo) to many files in a pool of processes. The work is described by
+a manifest, a list with one entry (a dictionary) per output file:
+
+     input: The .mid or .kar file to transform
+     output: Name of the output file, relative to the output directory
+       (default: the name of the input file). It may include
+       subdirectories, but not go out of the output directory
+     tracks2remove, patches2remove, channels2remove, t0, t1, transpose,
+       tempo: The transformation, as in midifile.write_variant. Missing
+       keys are taken from the default spec, if any
+
+Entries with the same input are done by the same process, which reads and
+parses the input once (load_file with keepevents=True) and writes all its
+outputs from memory. Each output is written to a temporary file in the
+output directory and renamed when complete, so a partial file never
+appears under the final name.
+
+   run_manifest(manifest, outdir, spec=None, processes=None,
+     reportfile=None): Runs the manifest (a list like the one above or the
+     name of a JSON file with it) and returns [results, report]. spec is a
+     dictionary with the default transformation. processes is the size of
+     the pool (default: number of CPUs). results has one dictionary per
+     entry, in manifest order, with input, output, the size of the output
+     file and the time spent, or error with the reason if it failed. A
+     file that can't be read or transformed only fails its own entries.
+     report is a dictionary with the number of entries, outputs written
+     and failures, the elapsed time and the outputs per second. If
+     reportfile is given, results and report are saved there (JSON).
+
+   transform_file(path, jobs, outdir): Does the entries (jobs) of one
+     input file in the current process. Returns their results.
+
+From the command line: python batch.py manifest.json outdir [report.json]
+"""
+
+import os, sys, time, json, tempfile, multiprocessing
+import midifile
+
+SPECKEYS=['tracks2remove','patches2remove','channels2remove','t0','t1','transpose','tempo']
+
+
+def _write_atomic(m,path,spec):
+    # Written to a temporary file first and renamed when it is complete
+    directory=os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError: # Created by another process
+            pass
+    [fd,tmppath]=tempfile.mkstemp(dir=directory,suffix='.tmp')
+    try:
+        f=os.fdopen(fd,'wb')
+        try:
+            m.write_variant(f,**spec)
+        finally:
+            f.close()
+        getattr(os,'replace',os.rename)(tmppath,path)
+    except:
+        os.remove(tmppath)
+        raise
+    return
+
+
+def _result(job,error=None):
+    result={'entry':job.get('entry'),'input':job['input'],'output':job['output']}
+    if error != None:
+        result['error']=error
+    return result
+
+
+def transform_file(path,jobs,outdir):
+    results=list()
+    t0=time.time()
+    m=midifile.midifile()
+    try:
+        if m.load_file(path,keepevents=True):
+            raise ValueError('Unsupported file (SMPTE time division)')
+    except Exception as e:
+        error='%s: %s' % (type(e).__name__,e)
+        return [_result(job,error) for job in jobs]
+    elapsed=time.time()-t0 # Parsing is shared by all the outputs
+    for job in jobs:
+        t0=time.time()
+        result=_result(job)
+        try:
+            spec=dict([[key,job[key]] for key in SPECKEYS if key in job])
+            outpath=os.path.join(outdir,job['output'])
+            _write_atomic(m,outpath,spec)
+            result['size']=os.path.getsize(outpath)
+        except Exception as e:
+            result['error']='%s: %s' % (type(e).__name__,e)
+        result['elapsed']=elapsed/len(jobs)+time.time()-t0
+        results.append(result)
+    return results
+
+
+def _safe_transform(args):
+    # Runs in the pool. Any failure ends up in the results, not in the pool
+    [path,jobs,outdir]=args
+    try:
+        return transform_file(path,jobs,outdir)
+    except Exception as e:
+        return [_result(job,'%s: %s' % (type(e).__name__,e)) for job in jobs]
+
+
+def _jobs(manifest,spec):
+    # Entries with the defaults filled in, grouped by input file
+    groups=dict()
+    order=list()
+    for ientry in range(len(manifest)):
+        entry=manifest[ientry]
+        job=dict([[key,value] for [key,value] in spec.items() if key in SPECKEYS])
+        job.update(entry)
+        if 'output' not in job:
+            job['output']=os.path.basename(job['input'])
+        job['entry']=ientry
+        unknown=[key for key in job if key not in SPECKEYS+['input','output','entry']]
+        if len(unknown) > 0:
+            job['error']='Unknown keys: %s' % ', '.join(sorted(unknown))
+        elif os.path.isabs(job['output']) or os.path.normpath(job['output']).startswith(os.pardir):
+            job['error']='Output out of the output directory: %s' % job['output']
+        if job['input'] not in groups:
+            groups[job['input']]=list()
+            order.append(job['input'])
+        groups[job['input']].append(job)
+    return [[path,groups[path]] for path in order]
+
+
+def run_manifest(manifest,outdir,spec=None,processes=None,reportfile=None):
+    t0=time.time()
+    if not isinstance(manifest,list):
+        f=open(manifest)
+        manifest=json.load(f)
+        f.close()
+    if spec == None:
+        spec=dict()
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    results=[None]*len(manifest)
+    tasks=list()
+    for [path,jobs] in _jobs(manifest,spec):
+        for job in jobs:
+            if 'error' in job: # Bad entry, the rest of the file goes on
+                results[job['entry']]=_result(job,job['error'])
+        jobs=[job for job in jobs if 'error' not in job]
+        if len(jobs) > 0:
+            tasks.append([path,jobs,outdir])
+
+    if len(tasks) > 0:
+        pool=multiprocessing.Pool(processes)
+        try:
+            for taskresults in pool.imap_unordered(_safe_transform,tasks):
+                for result in taskresults:
+                    results[result['entry']]=result
+        finally:
+            pool.close()
+            pool.join()
+
+    for result in results:
+        del result['entry']
+    elapsed=time.time()-t0
+    written=len([result for result in results if 'error' not in result])
+    report={'entries':len(results),'written':written,'failed':len(results)-written,
+            'elapsed':elapsed,'filespersecond':written/max(elapsed,1e-9)}
+    if reportfile != None:
+        f=open(reportfile,'w')
+        json.dump({'results':results,'report':report},f)
+        f.close()
+    return [results,report]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('Usage: python batch.py manifest.json outdir [report.json]')
+        sys.exit(1)
+    reportfile=None
+    if len(sys.argv) > 3:
+        reportfile=sys.argv[3]
+    [results,report]=run_manifest(sys.argv[1],sys.argv[2],reportfile=reportfile)
+    for result in results:
+        if 'error' in result:
+            print('%s: %s' % (result['input'],result['error']))
+    print('%(entries)d entries: %(written)d written, %(failed)d failed' % report)
+    print('%.1f s, %.1f files/s' % (report['elapsed'],report['filespersecond']))
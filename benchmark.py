@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+#
+# (c) 2015 Hector Socas-Navarro (hsocas.iac@gmail.com)
+#
+
+"""
+This module measures the speed of midifile on synthetic songs, so that
+the effect of a change in load_file, update_karaoke or write_file can be
+checked. Songs are generated from a seed, so the same parameters always
+give the same file and the results of different runs (or machines) can be
+compared. Nothing but the standard library is needed.
+
+   synthetic_song(seed=1, ntracks=4, notes=1000, density=4, running=True,
+     tempochanges=10, sysex=0, sysexsize=64, syllables=200): Returns the
+     bytes of a .kar file with a conductor track, the karaoke tracks and
+     ntracks instrument tracks of notes notes each. density is the mean
+     number of notes per quarter note, running selects whether running
+     status is used, tempochanges is the number of tempo changes (spread
+     over the song), sysex is the number of Sysex events of sysexsize
+     bytes in each instrument track and syllables is the number of
+     syllables of the lyrics.
+
+   measure(data, repeat=5, fps=30): Dictionary with the measures for the
+     song in data (bytes). Times are the best of repeat runs:
+       parse_events_per_s, parse_mb_per_s: load_file throughput
+       karaoke_p50_us, karaoke_p90_us, karaoke_p99_us, karaoke_max_us:
+         Percentiles of the time per call of update_karaoke, called at
+         fps frames per second for the whole song
+       write_mb_per_s: write_file throughput, removing one track
+       peak_kb: Peak memory allocated by load_file (Python 3 only)
+
+   run_suite(suite=SUITE, repeat=5): Runs measure on each song of the
+     suite, a list of [name, parameters of synthetic_song]. Returns a
+     dictionary with the measures of each name.
+
+   save_baseline(results, filename), load_baseline(filename): Keep the
+     results of a run in a JSON file.
+
+   compare(results, baseline, tolerance=0.3): List of [name, measure,
+     value, baseline value] with the measures that are worse than the
+     baseline by more than the given fraction. The maximum latency is
+     too noisy to be compared. On a busy machine timings may change by
+     20-30% from run to run, so a regression should be confirmed by
+     running the suite again.
+
+From the command line:
+   python benchmark.py                          Runs the suite
+   python benchmark.py save baseline.json       Also saves the baseline
+   python benchmark.py compare baseline.json [tolerance]
+                                                Also lists regressions
+                                                (exit status 1 if any)
+"""
+
+import struct, sys, os, io, gc, time, json, random, tempfile
+try:
+    import tracemalloc
+except ImportError: # Python 2. Peak memory is not measured
+    tracemalloc=None
+import midifile
+
+SUITE=[['default',{}],
+       ['dense',{'ntracks':2,'notes':20000,'density':32}],
+       ['manytracks',{'ntracks':64,'notes':200}],
+       ['norunning',{'running':False}],
+       ['tempo',{'tempochanges':2000}],
+       ['sysex',{'sysex':200,'sysexsize':1024}],
+       ['lyrics',{'notes':200,'syllables':5000}]]
+
+# Measures where a higher value is better. For the others lower is better
+HIGHER=['parse_events_per_s','parse_mb_per_s','write_mb_per_s']
+NOISY=['karaoke_max_us'] # Reported but not compared
+CLOCK=getattr(time,'perf_counter',time.time)
+DIVISION=96
+SYLLABLES=['la','di','da','hel','lo','wor','ld','ca','sa','mi','re','do']
+
+
+def _randint(r,a,b):
+    # Same numbers in Python 2 and 3 (random.randint is not)
+    return a+int(r.random()*(b-a+1))
+
+
+def _vlq(var):
+    out=bytearray([var&0x7F])
+    var=var>>7
+    while var > 0:
+        out.insert(0,(var&0x7F)|0x80)
+        var=var>>7
+    return out
+
+
+def _meta(metatype,data):
+    return bytearray([0xFF,metatype])+_vlq(len(data))+bytearray(data)
+
+
+def _chunk(events):
+    # MTrk chunk from [tick,bytes] events, sorted by tick
+    events.sort(key=lambda e: e[0])
+    data=bytearray()
+    tick=0
+    for [t,raw] in events:
+        data+=_vlq(t-tick)+raw
+        tick=t
+    data+=_vlq(0)+_meta(0x2F,b'')
+    return b'MTrk'+struct.pack('>I',len(data))+bytes(data)
+
+
+def synthetic_song(seed=1,ntracks=4,notes=1000,density=4,running=True,
+                   tempochanges=10,sysex=0,sysexsize=64,syllables=200):
+    r=random.Random(seed)
+    length=int(notes*DIVISION/float(density))+DIVISION # Song length in ticks
+
+    conductor=[[0,_meta(0x3,b'Conductor')],[0,_meta(0x58,[4,2,24,8])]]
+    for i in range(tempochanges+1):
+        tick=0 if i == 0 else _randint(r,1,length)
+        mpq=_randint(r,300000,900000)
+        conductor.append([tick,_meta(0x51,[mpq>>16,(mpq>>8)&0xFF,mpq&0xFF])])
+    chunks=[_chunk(conductor)]
+
+    chunks.append(_chunk([[0,_meta(0x1,b'@KMIDI KARAOKE FILE')],[0,_meta(0x1,b'@V0100')]]))
+    words=[[0,_meta(0x3,b'Words')]]
+    for i in range(syllables):
+        text=SYLLABLES[_randint(r,0,len(SYLLABLES)-1)]
+        if i%24 == 0:
+            text='\\'+text
+        elif i%6 == 0:
+            text='/'+text
+        if r.random() < 0.6:
+            text=text+' '
+        words.append([i*length//max(syllables,1),_meta(0x1,text.encode('latin-1'))])
+    chunks.append(_chunk(words))
+
+    for itrack in range(ntracks):
+        channel=itrack%16
+        events=[[0,_meta(0x3,('Track %d' % itrack).encode('latin-1'))],
+                [0,bytearray([0xC0|channel,_randint(r,0,127)])]]
+        for i in range(sysex):
+            blob=bytearray([_randint(r,0,127) for j in range(sysexsize)])+bytearray([0xF7])
+            events.append([_randint(r,0,length),bytearray([0xF0])+_vlq(len(blob))+blob])
+        for i in range(notes):
+            tick=_randint(r,0,length-DIVISION)
+            pitch=_randint(r,36,96)
+            events.append([tick,bytearray([0x90|channel,pitch,_randint(r,1,127)])])
+            events.append([tick+_randint(r,1,DIVISION),bytearray([0x90|channel,pitch,0])])
+        data=_chunk(events)
+        if running: # Drop the repeated status bytes
+            data=_running_status(data)
+        chunks.append(data)
+
+    header=b'MThd'+struct.pack('>IHHh',6,1,len(chunks),DIVISION)
+    return header+b''.join(chunks)
+
+
+def _running_status(chunk):
+    buf=midifile._buffer(bytes(chunk))
+    data=midifile._encode_events(midifile._track_events(buf,8,len(buf)))
+    return b'MTrk'+struct.pack('>I',len(data))+data
+
+
+def _best(function,repeat):
+    best=None
+    for i in range(repeat):
+        gc.collect()
+        t0=CLOCK()
+        function()
+        elapsed=CLOCK()-t0
+        if best == None or elapsed < best:
+            best=elapsed
+    return max(best,1e-9)
+
+
+def _percentile(values,fraction):
+    return values[min(int(fraction*len(values)),len(values)-1)]
+
+
+def measure(data,repeat=5,fps=30):
+    results=dict()
+    def load():
+        m=midifile.midifile()
+        m.load_file(io.BytesIO(data))
+        return m
+    m=load()
+    nevents=0
+    buf=midifile._buffer(data)
+    for [pos,tracklen] in m.trackindex:
+        for event in midifile._track_events(buf,pos,pos+tracklen):
+            nevents=nevents+1
+    if midifile.PY3:
+        buf.release()
+    elapsed=_best(load,repeat)
+    results['parse_events_per_s']=nevents/elapsed
+    results['parse_mb_per_s']=len(data)/1048576./elapsed
+
+    # update_karaoke frame by frame, as a player would do
+    latencies=list()
+    for i in range(repeat):
+        m.seek_karaoke(0.)
+        clock=CLOCK
+        for iframe in range(int(m.duration*fps)+1):
+            t0=clock()
+            m.update_karaoke(iframe/float(fps))
+            latencies.append(clock()-t0)
+    latencies.sort()
+    for [name,fraction] in [['p50',0.5],['p90',0.9],['p99',0.99],['max',1.]]:
+        results['karaoke_%s_us' % name]=_percentile(latencies,fraction)*1e6
+
+    directory=tempfile.mkdtemp()
+    try:
+        filein=os.path.join(directory,'in.kar')
+        fileout=os.path.join(directory,'out.kar')
+        f=open(filein,'wb')
+        f.write(data)
+        f.close()
+        def write():
+            midifile.midifile().write_file(filein,fileout,[len(m.trackindex)-1],[])
+        results['write_mb_per_s']=len(data)/1048576./_best(write,repeat)
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory,name))
+        os.rmdir(directory)
+
+    if tracemalloc != None:
+        m=None
+        gc.collect()
+        tracemalloc.start()
+        try:
+            m=load()
+            results['peak_kb']=tracemalloc.get_traced_memory()[1]/1024.
+        finally:
+            tracemalloc.stop()
+    return results
+
+
+def run_suite(suite=SUITE,repeat=5):
+    results=dict()
+    for [name,parameters] in suite:
+        results[name]=measure(synthetic_song(**parameters),repeat)
+    return results
+
+
+def save_baseline(results,filename):
+    f=open(filename,'w')
+    json.dump({'python':sys.version.split()[0],'results':results},f,indent=1,sort_keys=True)
+    f.close()
+    return
+
+
+def load_baseline(filename):
+    f=open(filename)
+    baseline=json.load(f)
+    f.close()
+    return baseline['results']
+
+
+def compare(results,baseline,tolerance=0.3):
+    regressions=list()
+    for name in sorted(results):
+        for measurename in sorted(results[name]):
+            value=results[name][measurename]
+            reference=baseline.get(name,dict()).get(measurename)
+            if reference == None or measurename in NOISY:
+                continue
+            if measurename in HIGHER:
+                worse=value < reference*(1.-tolerance)
+            else:
+                worse=value > reference*(1.+tolerance)
+            if worse:
+                regressions.append([name,measurename,value,reference])
+    return regressions
+
+
+if __name__ == '__main__':
+    results=run_suite()
+    for name in sorted(results):
+        print(name)
+        for measurename in sorted(results[name]):
+            print('   %-20s %14.1f' % (measurename,results[name][measurename]))
+    if len(sys.argv) > 2 and sys.argv[1] == 'save':
+        save_baseline(results,sys.argv[2])
+    elif len(sys.argv) > 2 and sys.argv[1] == 'compare':
+        tolerance=0.3
+        if len(sys.argv) > 3:
+            tolerance=float(sys.argv[3])
+        regressions=compare(results,load_baseline(sys.argv[2]),tolerance)
+        for [name,measurename,value,reference] in regressions:
+            print('Regression in %s %s: %.1f (baseline %.1f)' % (name,measurename,value,reference))
+        if len(regressions) > 0:
+            sys.exit(1)
+    elif len(sys.argv) > 1:
+        print('Usage: python benchmark.py [save|compare baseline.json [tolerance]]')
+        sys.exit(1)
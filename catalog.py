@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#
+# (c) 2015 Hector Socas-Navarro (hsocas.iac@gmail.com)
+#
+
+"""
+This module builds a catalog of a song library: it walks a directory
+tree, parses every .kar/.mid file with midifile in a pool of processes and
+produces one record (a dictionary) per song with:
+
+     path, size, mtime: The file and its size and modification time
+     karfile: True if it has karaoke information
+     tracknames: Names of the tracks
+     duration: Time (in seconds) at which the last track ends
+     tempo: Initial, minimum and maximum tempo (quarter notes per minute)
+       and number of tempo changes
+     timesignatures: List of the [numerator, denominator] used
+     patches: Sorted list of the patches (instruments) used
+     notes: Number of notes, and notespertrack with the count per track
+     lyrics: Lyrics text (see midifile.karaoke_text)
+     error: Only present if the file could not be parsed, with the reason
+
+   index_directory(directory, catalogfile=None, processes=None): Returns
+     [records, report]. If catalogfile is given, the catalog is read from
+     it (if it exists) and files whose size and modification time did not
+     change are not parsed again; the new catalog is then saved there
+     (JSON). processes is the size of the pool (default: number of CPUs).
+     report is a dictionary with the number of files parsed, skipped and
+     failed, the elapsed time and the throughput in files and MB per
+     second. A file that fails to parse only gets an error record.
+
+   song_record(path): Record for a single file.
+
+From the command line: python catalog.py directory catalog.json
+"""
+
+import os, sys, time, json, multiprocessing
+import midifile
+
+VERSION=1 # Records from catalogs with another version are rebuilt
+EXTENSIONS=['.kar','.mid','.midi']
+
+
+def song_record(path):
+    st=os.stat(path)
+    record={'path':path,'size':st.st_size,'mtime':st.st_mtime}
+    m=midifile.midifile()
+    if m.load_file(path):
+        record['error']='Unsupported file (SMPTE time division)'
+        return record
+    tempos=_values([[[60000000./mpq],t] for [mpq,t] in m.microsecondsperquarternote])
+    tempos=[tempo[0] for tempo in tempos]
+    signatures=_values([[[int(m.num[i][0]),int(m.den[i][0])],m.num[i][1]] for i in range(len(m.num))])
+    notespertrack=[0]*m.ntracks
+    for note in m.notes:
+        notespertrack[note[4]]=notespertrack[note[4]]+1
+    record.update({'karfile':m.karfile,'tracknames':m.tracknames,'duration':m.duration,
+                   'tempo':{'initial':tempos[0],'min':min(tempos),'max':max(tempos),'changes':len(tempos)-1},
+                   'timesignatures':signatures,
+                   'patches':sorted(set([patch[1] for patch in m.patchesused])),
+                   'notes':len(m.notes),'notespertrack':notespertrack,
+                   'lyrics':m.karaoke_text()})
+    return record
+
+
+def _values(values):
+    # Values taken by a midifile tempo list ([[value,time],...]), without
+    # repetitions nor the defaults replaced at time 0
+    out=list()
+    for [value,t] in values:
+        if len(out) > 0 and t == 0.:
+            out[-1]=value
+        elif len(out) == 0 or out[-1] != value:
+            out.append(value)
+    return out
+
+
+def _safe_record(path):
+    # Runs in the pool. Any failure ends up in the record, not in the pool,
+    # with the size and mtime so that the file is skipped while unchanged
+    record={'path':path}
+    try:
+        st=os.stat(path)
+        record.update({'size':st.st_size,'mtime':st.st_mtime})
+        return song_record(path)
+    except Exception as e:
+        record['error']='%s: %s' % (type(e).__name__,e)
+        return record
+
+
+def find_songs(directory):
+    paths=list()
+    for [root,dirs,files] in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in EXTENSIONS:
+                paths.append(os.path.join(root,name))
+    return paths
+
+
+def index_directory(directory,catalogfile=None,processes=None):
+    t0=time.time()
+    old=dict()
+    if catalogfile != None and os.path.exists(catalogfile):
+        f=open(catalogfile)
+        catalog=json.load(f)
+        f.close()
+        if catalog.get('version') == VERSION:
+            old=dict([[record['path'],record] for record in catalog['records']])
+
+    records=dict()
+    toparse=list()
+    for path in find_songs(directory):
+        st=os.stat(path)
+        record=old.get(path)
+        if record != None and record.get('size') == st.st_size and record.get('mtime') == st.st_mtime:
+            records[path]=record # Unchanged
+        else:
+            toparse.append(path)
+
+    nbytes=0
+    if len(toparse) > 0:
+        pool=multiprocessing.Pool(processes)
+        try:
+            for record in pool.imap_unordered(_safe_record,toparse,chunksize=8):
+                records[record['path']]=record
+                nbytes=nbytes+record.get('size',0)
+        finally:
+            pool.close()
+            pool.join()
+
+    records=[records[path] for path in sorted(records)]
+    if catalogfile != None:
+        f=open(catalogfile,'w')
+        json.dump({'version':VERSION,'records':records},f)
+        f.close()
+
+    elapsed=time.time()-t0
+    report={'files':len(records),'parsed':len(toparse),'skipped':len(records)-len(toparse),
+            'failed':len([record for record in records if 'error' in record]),
+            'elapsed':elapsed,'filespersecond':len(toparse)/max(elapsed,1e-9),
+            'mbpersecond':nbytes/1048576./max(elapsed,1e-9)}
+    return [records,report]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python catalog.py directory [catalog.json]')
+        sys.exit(1)
+    catalogfile=None
+    if len(sys.argv) > 2:
+        catalogfile=sys.argv[2]
+    [records,report]=index_directory(sys.argv[1],catalogfile)
+    print('%(files)d songs: %(parsed)d parsed, %(skipped)d unchanged, %(failed)d failed' % report)
+    print('%.1f s, %.1f files/s, %.2f MB/s' % (report['elapsed'],report['filespersecond'],report['mbpersecond']))
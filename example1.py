@@ -4,25 +4,21 @@
 # It doesn't play any music, just shows the lyrics. It has no additional 
 # requirements. 
 
-import midifile, time, datetime
+import midifile, karscheduler
 
 filename=raw_input('Please enter filename of .mid or .kar file:')
 m=midifile.midifile()
-m.load_file(filename)
-start=datetime.datetime.now()
-#start=start-datetime.timedelta(0,15) # To start at a later point
-
-dt=0.
-while dt < max(m.kartimes)+2:
-    dt=(datetime.datetime.now()-start).total_seconds()
-    m.update_karaoke(dt)
+m.load_file(filename,lyricsonly=True)
 
+def show(m): # Called by the scheduler every time a syllable starts
     print ''
-    print 't=',dt,' of ',max(m.kartimes)
+    print 't=',s.songtime(),' of ',max(m.kartimes)
     for iline in range(3):
         print m.karlinea[iline]+'__'+m.karlineb[iline]
     print ''
 
-    time.sleep(.1)
+s=karscheduler.karscheduler(m,onsyllable=show)
+s.run()
+#s.run(15) # To start at a later point
 
 
@@ -5,17 +5,16 @@
 # This adds music to example1.py using the power of pygame. 
 # Requires: pygame. 
 
-import midifile, time, datetime, sys
+import midifile, karscheduler, time, sys
 import pygame
 
 filename=raw_input('Please enter filename of .mid or .kar file:')
 m=midifile.midifile()
-m.load_file(filename)
+m.load_file(filename,lyricsonly=True)
 
 pygame.mixer.init()
 pygame.mixer.music.load(filename)
 pygame.mixer.music.play(0,0) # Start song at 0 and don't loop
-start=datetime.datetime.now()
 
 if not m.karfile:
     print "This is not a karaoke file. I'll just play it"
@@ -24,18 +23,22 @@ if not m.karfile:
     sys.exit(0)
 
 
-#start=start-datetime.timedelta(0,90) # To start lyrics at a later point
-dt=0.
-while pygame.mixer.music.get_busy():
-    dt=(datetime.datetime.now()-start).total_seconds()
-    m.update_karaoke(dt)
+def position(): # Where the music is, to keep the lyrics in sync
+    pos=pygame.mixer.music.get_pos()
+    if pos < 0:
+        return None
+    return pos/1000.
 
+def show(m): # Called by the scheduler every time a syllable starts
     print ''
-    print 't=',dt,' of ',max(m.kartimes)
+    print 't=',s.songtime(),' of ',max(m.kartimes)
     for iline in range(3):
         print m.karlinea[iline]+'__'+m.karlineb[iline]
     print ''
 
-    time.sleep(.1)
+s=karscheduler.karscheduler(m,onsyllable=show,position=position,tolerance=0.05)
+s.run()
+while pygame.mixer.music.get_busy():
+    time.sleep(1)
 
 
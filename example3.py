@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 
 # This example shows how to use pygame to build a graphic frontend for
-#  a karaoke application. 
+#  a karaoke application. The lines are drawn by karrenderer, which only
+#  redraws what changed on each frame.
 # Requires: pygame.
 
-import midifile, time, datetime, sys
+import midifile, karrenderer, time, datetime, sys
 import pygame
 
 filename=raw_input('Please enter filename of .mid or .kar file:')
@@ -18,7 +19,8 @@ color1=(100,100,250,0)
 color2=(250,250,250,0)
 
 m=midifile.midifile()
-m.load_file(filename)
+m.load_file(filename,lyricsonly=True)
+renderer=karrenderer.karrenderer(screen,font,color1,color2)
 
 pygame.mixer.init()
 pygame.mixer.music.load(filename)
@@ -34,22 +36,16 @@ if not m.karfile:
 
 #start=start-datetime.timedelta(0,9) # To start lyrics at a later point
 dt=0.
+clock=pygame.time.Clock()
 while pygame.mixer.music.get_busy():
     dt=(datetime.datetime.now()-start).total_seconds()
     m.update_karaoke(dt)
 
-    for iline in range(3):
-        l=font.size(m.karlinea[iline]+m.karlineb[iline])[0]
-        x0a=screenx/2-l/2.
-        linea=font.render(m.karlinea[iline],0,color1)
-        lineb=font.render(m.karlineb[iline],0,color2)
-        recta=screen.blit(linea,[x0a,80+iline*60])
-        x0b=x0a+recta.width
-        recbt=screen.blit(lineb,[x0b,80+iline*60])
+    rects=renderer.draw(m,dt) # Syllables are colored progressively
+    if len(rects) > 0:
+        pygame.display.update(rects)
+    pygame.event.pump()
 
-    pygame.display.update()
-    screen.fill(0)
-
-    time.sleep(.1)
+    clock.tick(60) # Frames per second
 
 
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+#
+# (c) 2015 Hector Socas-Navarro (hsocas.iac@gmail.com)
+#
+
+"""
+This module computes fingerprints of songs from their notes and lyrics, to
+find near duplicates in a song library (files re-encoded, re-titled, with
+the tracks in another order or the timing slightly shifted) without
+comparing every pair of songs. A fingerprint has two MinHash signatures of
+NUMHASHES values each:
+
+     notes: From the n-grams of the intervals (in semitones) between the
+       consecutive notes of the melody. The melody is the highest pitch of
+       each onset, with the notes of all the tracks (but the drums, channel
+       index 9) merged, so it doesn't depend on the tempo, the order of the
+       tracks, the key or small shifts of the timing
+     lyrics: From the groups of SHINGLE consecutive characters of the
+       lyrics, in lowercase and without spaces or punctuation
+
+Each one is None if the song has no notes (or lyrics). The fraction of
+values that two signatures have in common estimates the similarity
+(Jaccard index) of their sets of n-grams. numpy is used, if available, to
+compute the signatures faster (the values are the same without it).
+
+   fingerprint(m): Fingerprint (a dictionary) of midifile or song object m
+     (on which load_file() has been run, not with lyricsonly).
+
+   fingerprint_file(path): Same as above, parsing file path.
+
+   similarity(fp1, fp2): Estimated similarity (0 to 1) of two songs, the
+     mean of that of the signatures that both have (0 if none).
+
+   fingerprintindex(bands=BANDS): Locality sensitive hashing index of
+     fingerprints. Each signature is split in bands and songs that have
+     the same values in a band are candidates, so a query only compares
+     the songs in its buckets. With NUMHASHES=64 and 16 bands, pairs with
+     a similarity of 0.5 are found with a probability of 0.64, of 0.7 with
+     0.99 and of 0.8 with almost 1. More bands find pairs with lower
+     similarity, at the cost of more candidates.
+
+     Methods:
+       add(name, fp): Adds the fingerprint of a song (replacing the old
+         one, if name was already in the index)
+       remove(name): Removes a song
+       candidates(fp): Set of the names of the songs that share a bucket
+         with fp
+       query(fp, threshold=0.5): List of [name, similarity] of the
+         candidates with a similarity of at least threshold, most similar
+         first
+       duplicates(threshold=0.5): List of [name1, name2, similarity] with
+         each pair of songs in the index with a similarity of at least
+         threshold, most similar first
+       save(filename): Saves the fingerprints to a file (JSON)
+
+   load_index(filename): Returns the fingerprintindex saved in filename.
+
+   index_directory(directory, processes=None): Returns a fingerprintindex
+     with the .kar/.mid files found in a directory tree, parsed in a pool
+     of processes (default: number of CPUs). Files that can't be parsed
+     are left out.
+"""
+
+import re, json, zlib, random, multiprocessing
+try:
+    import numpy
+except ImportError:
+    numpy=None
+import midifile, catalog
+
+VERSION=2
+NUMHASHES=64
+BANDS=16
+NGRAM=4 # Intervals per n-gram of the melody
+SHINGLE=5 # Characters per shingle of the lyrics
+ONSETGAP=0.05 # Notes starting closer than this (in quarter notes) are a chord
+DRUMS=9
+PRIME=2147483647 # 2**31-1
+
+# Parameters of the hash functions (a*x+b)%PRIME. Fixed, so fingerprints
+# saved on any machine can be compared
+_random=random.Random(12345)
+_HASHA=[1+int(_random.random()*(PRIME-1)) for i in range(NUMHASHES)]
+_HASHB=[int(_random.random()*PRIME) for i in range(NUMHASHES)]
+del _random
+
+
+def _melody(m):
+    # Highest pitch of each onset, from the notes of all the tracks. The
+    # onsets are compared in ticks, which don't change with the tempo
+    if len(m.notes) == 0:
+        return list()
+    sec2tick=m.tempomap.sec2tick
+    notes=sorted([[sec2tick(note[5]),note[0]] for note in m.notes if note[2] != DRUMS])
+    melody=list()
+    t0=None
+    for [ton,pitch] in notes:
+        if t0 == None or ton-t0 > ONSETGAP*m.division:
+            melody.append(pitch)
+            t0=ton
+        elif pitch > melody[-1]:
+            melody[-1]=pitch
+    return melody
+
+
+def _note_shingles(m):
+    melody=_melody(m)
+    intervals=[melody[i+1]-melody[i] for i in range(len(melody)-1)]
+    return set([','.join([str(v) for v in intervals[i:i+NGRAM]])
+                for i in range(len(intervals)-NGRAM+1)])
+
+
+def _lyric_shingles(m):
+    text=midifile._karaoke_text(m.karsyl)
+    if not midifile.PY3: # Same shingles as in Python 3
+        text=text.decode('latin-1')
+    text=re.sub(r'[\W_]+','',text.lower(),flags=re.UNICODE)
+    return set([text[i:i+SHINGLE] for i in range(len(text)-SHINGLE+1)])
+
+
+def _minhash(shingles):
+    if len(shingles) == 0:
+        return None
+    values=[zlib.crc32(shingle.encode('utf-8')) & 0xFFFFFFFF for shingle in sorted(shingles)]
+    values=[value % PRIME for value in values]
+    if numpy != None:
+        x=numpy.array(values,dtype=numpy.int64)
+        a=numpy.array(_HASHA,dtype=numpy.int64)[:,None]
+        b=numpy.array(_HASHB,dtype=numpy.int64)[:,None]
+        return [int(v) for v in ((a*x+b) % PRIME).min(axis=1)]
+    return [min([(a*x+b) % PRIME for x in values]) for [a,b] in zip(_HASHA,_HASHB)]
+
+
+def fingerprint(m):
+    return {'notes':_minhash(_note_shingles(m)),'lyrics':_minhash(_lyric_shingles(m))}
+
+
+def fingerprint_file(path):
+    m=midifile.midifile()
+    if m.load_file(path):
+        raise ValueError('Unsupported file (SMPTE time division)')
+    return fingerprint(m)
+
+
+def similarity(fp1,fp2):
+    values=list()
+    for kind in ['notes','lyrics']:
+        [sig1,sig2]=[fp1.get(kind),fp2.get(kind)]
+        if sig1 != None and sig2 != None:
+            values.append(len([1 for [v1,v2] in zip(sig1,sig2) if v1 == v2])/float(len(sig1)))
+    if len(values) == 0:
+        return 0.
+    return sum(values)/len(values)
+
+
+class fingerprintindex(object):
+
+    def __init__(self,bands=BANDS):
+        self.bands=bands
+        self.fingerprints=dict()
+        self.buckets=dict() # Names of the songs by (kind, band, values)
+        return
+
+    def _keys(self,fp):
+        keys=list()
+        for kind in ['notes','lyrics']:
+            sig=fp.get(kind)
+            if sig == None:
+                continue
+            rows=len(sig)//self.bands
+            for band in range(self.bands):
+                keys.append((kind,band,tuple(sig[band*rows:(band+1)*rows])))
+        return keys
+
+    def add(self,name,fp):
+        if name in self.fingerprints:
+            self.remove(name)
+        self.fingerprints[name]=fp
+        for key in self._keys(fp):
+            if key not in self.buckets:
+                self.buckets[key]=list()
+            self.buckets[key].append(name)
+        return
+
+    def remove(self,name):
+        fp=self.fingerprints.pop(name)
+        for key in self._keys(fp):
+            self.buckets[key].remove(name)
+            if len(self.buckets[key]) == 0:
+                del self.buckets[key]
+        return
+
+    def candidates(self,fp):
+        names=set()
+        for key in self._keys(fp):
+            names.update(self.buckets.get(key,[]))
+        return names
+
+    def query(self,fp,threshold=0.5):
+        hits=list()
+        for name in self.candidates(fp):
+            value=similarity(fp,self.fingerprints[name])
+            if value >= threshold:
+                hits.append([name,value])
+        hits.sort(key=lambda hit: (-hit[1],hit[0]))
+        return hits
+
+    def duplicates(self,threshold=0.5):
+        pairs=list()
+        for name1 in self.fingerprints:
+            for [name2,value] in self.query(self.fingerprints[name1],threshold):
+                if name1 < name2:
+                    pairs.append([name1,name2,value])
+        pairs.sort(key=lambda pair: (-pair[2],pair[0],pair[1]))
+        return pairs
+
+    def save(self,filename):
+        f=open(filename,'w')
+        json.dump({'version':VERSION,'bands':self.bands,'fingerprints':self.fingerprints},f)
+        f.close()
+        return
+
+
+def load_index(filename):
+    f=open(filename)
+    data=json.load(f)
+    f.close()
+    if data.get('version') != VERSION:
+        raise ValueError('fingerprint index version %s, expected %d' % (data.get('version'),VERSION))
+    index=fingerprintindex(data['bands'])
+    for [name,fp] in data['fingerprints'].items():
+        index.add(name,fp)
+    return index
+
+
+def _safe_fingerprint(path):
+    # Runs in the pool. A damaged file gets None
+    try:
+        return [path,fingerprint_file(path)]
+    except Exception:
+        return [path,None]
+
+
+def index_directory(directory,processes=None):
+    index=fingerprintindex()
+    paths=catalog.find_songs(directory)
+    if len(paths) == 0:
+        return index
+    pool=multiprocessing.Pool(processes)
+    try:
+        for [path,fp] in pool.imap_unordered(_safe_fingerprint,paths,chunksize=8):
+            if fp != None:
+                index.add(path,fp)
+    finally:
+        pool.close()
+        pool.join()
+    return index
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# (c) 2015 Hector Socas-Navarro (hsocas.iac@gmail.com)
+#
+
+import pygame
+
+class karrenderer(object):
+
+    """
+This module defines the class karrenderer, which draws the karaoke lines
+of a midifile object (or a playbackcursor) on a pygame surface. The text
+of a page is rendered once, in both colors, when the page is shown. On
+each frame only the part of each line between the old and the new
+highlight position is copied from the colored text, and the rectangles
+that changed are returned, so that pygame.display.update only refreshes
+them. Nothing is drawn when nothing changed. Requires: pygame.
+
+It also works without a display (e.g., for tests) with the dummy video
+driver of SDL: set the environment variable SDL_VIDEODRIVER=dummy and
+draw on a pygame.Surface.
+
+   karrenderer(surface, font, color1=(100,100,250), color2=(250,250,250),
+     top=80, linespacing=60, background=(0,0,0)): surface is where the
+     lines are drawn (e.g., the screen), font a pygame.font.Font, color1
+     the color of the text already sung and color2 that of the text not
+     sung yet. The lines are centered horizontally, the first one at
+     top pixels from the top and the others linespacing pixels below
+     the previous one.
+
+METHODS:
+
+   draw(m, dt=None): Updates the surface to the current karlinea and
+     karlineb of m (call m.update_karaoke first). If dt (the same time
+     given to update_karaoke) is given, the syllable being sung is
+     colored progressively from its start to the start of the next one,
+     instead of at once. Returns the list of rectangles that changed.
+
+   redraw(): Draws everything again (e.g., after the surface was
+     cleared) on the next call to draw.
+"""
+
+    def __init__(self,surface,font,color1=(100,100,250),color2=(250,250,250),
+                 top=80,linespacing=60,background=(0,0,0)):
+        self.surface=surface
+        self.font=font
+        self.color1=color1
+        self.color2=color2
+        self.top=top
+        self.linespacing=linespacing
+        self.background=background
+        self.redraw()
+        return
+
+    def redraw(self):
+        self.page=None # Text of the lines being displayed
+        self.rendered=[None]*3 # Each line rendered in both colors
+        self.positions=[None]*3 # Where each line is drawn
+        self.splits=[0]*3 # Width of the colored part of each line
+        self.widths=dict() # Widths of the colored parts, by text
+        return
+
+    def _width(self,text):
+        if text not in self.widths:
+            self.widths[text]=self.font.size(text)[0]
+        return self.widths[text]
+
+    def _draw_page(self,page):
+        # Renders the lines of a new page and draws them not sung yet
+        rects=list()
+        for iline in range(3):
+            if self.rendered[iline] != None: # Clear the old lines
+                rects.append(self.surface.fill(self.background,self.positions[iline]))
+        for iline in range(3):
+            if page[iline] == '':
+                self.rendered[iline]=None
+                continue
+            line1=self.font.render(page[iline],0,self.color1)
+            line2=self.font.render(page[iline],0,self.color2)
+            x=(self.surface.get_width()-line2.get_width())//2
+            position=pygame.Rect(x,self.top+iline*self.linespacing,
+                                 line2.get_width(),line2.get_height())
+            self.rendered[iline]=[line1,line2]
+            self.positions[iline]=position
+            rects.append(self.surface.blit(line2,position))
+        self.page=page
+        self.splits=[0]*3
+        self.widths=dict()
+        return rects
+
+    def _split(self,m,iline,dt):
+        # Width of the colored part of line iline
+        linea=m.karlinea[iline]
+        width=self._width(linea)
+        if dt == None or linea == '' or not m.karievent0[iline] <= m.karidx <= m.karievent1[iline]:
+            return width
+        # Part of the syllable being sung, by time
+        idx=m.karidx
+        syl=m.karsyl[idx].replace('\\','').replace('/','')
+        if idx+1 >= len(m.kartimes) or not linea.endswith(syl):
+            return width
+        t0=m.kartimes[idx]
+        t1=m.kartimes[idx+1]
+        if t1 <= t0:
+            return width
+        fraction=min(max((dt-t0)/(t1-t0),0.),1.)
+        width0=self._width(linea[:len(linea)-len(syl)])
+        return int(width0+fraction*(width-width0))
+
+    def draw(self,m,dt=None):
+        page=tuple([m.karlinea[iline]+m.karlineb[iline] for iline in range(3)])
+        rects=list()
+        if page != self.page:
+            rects=self._draw_page(page)
+        for iline in range(3):
+            if self.rendered[iline] == None:
+                continue
+            split=min(self._split(m,iline,dt),self.positions[iline].width)
+            old=self.splits[iline]
+            if split == old:
+                continue
+            # Copy the part between the old and new positions of the
+            # highlight from the line in the right color
+            [line1,line2]=self.rendered[iline]
+            x0=min(old,split)
+            area=pygame.Rect(x0,0,abs(split-old),self.positions[iline].height)
+            line=line1 if split > old else line2
+            rect=self.surface.fill(self.background,area.move(self.positions[iline].topleft))
+            self.surface.blit(line,rect,area)
+            rects.append(rect)
+            self.splits[iline]=split
+        return rects
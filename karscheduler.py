@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#
+# (c) 2015 Hector Socas-Navarro (hsocas.iac@gmail.com)
+#
+
+import time, threading
+try:
+    import asyncio
+except ImportError: # Python 2. Only the thread and blocking modes work
+    asyncio=None
+
+class karscheduler(object):
+
+    """
+This module defines the class karscheduler, which drives the karaoke
+display of a midifile object without polling. It knows from kartimes when
+the next syllable starts, sleeps until then and calls update_karaoke at
+that very moment, followed by the callbacks for the transitions that took
+place. Between syllables it does nothing.
+
+   karscheduler(m, onsyllable=None, online=None, onpage=None, onend=None,
+     clock=None, position=None, sleep=None, tolerance=0.005)
+
+     m is a midifile object on which load_file() has been run (or a
+     playbackcursor, see midifile.song). The
+     callbacks receive m as their only argument, once karlinea and
+     karlineb have been updated. On each transition onpage is called if
+     a new page is displayed, online if the line being sung changed and
+     onsyllable if the syllable changed (so a new page calls the three).
+     onend is called once, when the song end is reached.
+
+     clock is a function returning a monotonic time in seconds (default
+     time.monotonic). position is an optional function returning the
+     actual position of the playback in seconds (e.g., from the audio
+     player). When given, the song time is corrected against it whenever
+     they differ by more than tolerance seconds. sleep(seconds) is used
+     by run() to wait (default time.sleep). A fake clock and sleep can be
+     passed to test code without waiting.
+
+METHODS:
+
+   run(dt=0.): Runs the schedule in the current thread starting at song
+     time dt, until the end or until stop() is called.
+
+   start(dt=0.): Same as run() but in a background thread. Returns the
+     thread.
+
+   schedule(dt=0., loop=None): Runs the schedule in an asyncio event loop
+     with loop.call_later (Python 3). Returns a future that is done at
+     the end of the song.
+
+   stop(): Stops the schedule.
+
+   songtime(): Current song time in seconds.
+"""
+
+    epsilon=1e-6 # Wake up this much after a syllable starts
+
+    def __init__(self,m,onsyllable=None,online=None,onpage=None,onend=None,
+                 clock=None,position=None,sleep=None,tolerance=0.005):
+        self.m=m
+        self.onsyllable=onsyllable
+        self.online=online
+        self.onpage=onpage
+        self.onend=onend
+        if clock == None:
+            clock=getattr(time,'monotonic',time.time)
+        if sleep == None:
+            sleep=time.sleep
+        self.clock=clock
+        self.position=position
+        self.sleep=sleep
+        self.tolerance=tolerance
+        # Times at which update_karaoke may change something
+        self.times=sorted(set(m.kartimes))
+        self.itime=0
+        self.clock0=0.
+        self.dt0=0.
+        self.state=None
+        self._delay=None
+        self.stopped=threading.Event()
+        self.future=None
+        self.handle=None
+        return
+
+    def songtime(self):
+        dt=self.clock()-self.clock0+self.dt0
+        if self.position != None:
+            position=self.position()
+            if position != None and abs(position-dt) > self.tolerance: # Drift
+                self.clock0=self.clock()
+                self.dt0=position
+                dt=position
+        return dt
+
+    def _reset(self,dt):
+        self.clock0=self.clock()
+        self.dt0=dt
+        self.itime=0
+        self.state=None
+        self.stopped.clear()
+        self._delay=self._step()
+
+    def _step(self):
+        # Processes the transitions that are due. Returns the time to wait
+        # until the next one, or None if the song is over
+        dt=self.songtime()
+        while self.itime < len(self.times) and self.times[self.itime] < dt:
+            self.itime=self.itime+1
+        m=self.m
+        m.update_karaoke(dt)
+        idx=m.karidx
+        iline=0
+        while iline < 2 and idx > m.karievent1[iline]:
+            iline=iline+1
+        state=[m.karievent0[0],iline,idx]
+        previous=self.state
+        self.state=state
+        if previous == None or state[0] != previous[0]:
+            if self.onpage != None:
+                self.onpage(m)
+        if previous == None or state[:2] != previous[:2]:
+            if self.online != None:
+                self.online(m)
+        if previous == None or state != previous:
+            if self.onsyllable != None:
+                self.onsyllable(m)
+        if self.itime >= len(self.times):
+            if self.onend != None:
+                self.onend(m)
+            return None
+        return self.times[self.itime]-dt+self.epsilon
+
+    def run(self,dt=0.):
+        self._reset(dt)
+        self._loop(self.sleep)
+        return
+
+    def start(self,dt=0.):
+        self._reset(dt)
+        thread=threading.Thread(target=self._loop,args=[self.stopped.wait])
+        thread.daemon=True
+        thread.start()
+        return thread
+
+    def _loop(self,sleep):
+        while self._delay != None and not self.stopped.is_set():
+            sleep(self._delay)
+            if self.stopped.is_set():
+                break
+            self._delay=self._step()
+        return
+
+    def schedule(self,dt=0.,loop=None):
+        if asyncio == None:
+            raise ImportError('asyncio is not available, use start() instead')
+        if loop == None:
+            loop=asyncio.get_event_loop()
+        self.loop=loop
+        self.future=loop.create_future()
+        self._reset(dt)
+        self._callback()
+        return self.future
+
+    def _callback(self):
+        if self.stopped.is_set():
+            if not self.future.done():
+                self.future.set_result(False)
+            return
+        if self._delay == None:
+            if not self.future.done():
+                self.future.set_result(True)
+            return
+        self.handle=self.loop.call_later(self._delay,self._async_step)
+
+    def _async_step(self):
+        self._delay=self._step()
+        self._callback()
+
+    def stop(self):
+        self.stopped.set()
+        if self.handle != None: # Running in asyncio
+            self.handle.cancel()
+            self.loop.call_soon_threadsafe(self._callback)
+        return
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# (c) 2015 Hector Socas-Navarro (hsocas.iac@gmail.com)
+#
+
+"""
+This module defines the class lyricindex, an inverted index of the lyrics
+of a song library, to find songs by a phrase of their lyrics without
+parsing the files. The words of each song are rebuilt from the karsyl
+syllables (a word ends at a space or at a '/' or '\\' mark) and each word
+keeps the time (from kartimes) of its first syllable. Words are indexed in
+lowercase and without punctuation, with their position in the song.
+
+   lyricindex(): Empty index.
+
+   add_song(path, m): Adds the lyrics of midifile object m (on which
+     load_file() has been run) under the name path. If path was already
+     in the index, its old lyrics are removed first.
+
+   add_file(path): Same as above, parsing only the lyrics of file path.
+
+   remove_song(path): Removes a song from the index.
+
+   search(phrase, prefix=False): Returns a list of [path, time] with each
+     place where the words of phrase appear one after the other, time
+     being the time (in seconds) of the first one. If prefix is True, the
+     last word of phrase may be the beginning of a word (so 'hel' finds
+     'hello').
+
+   save(filename): Saves the index to a file (JSON).
+
+   load_index(filename): Returns the lyricindex saved in filename.
+
+   index_directory(directory): Returns a lyricindex with the .kar/.mid
+     files found in a directory tree. Files that can't be parsed are left
+     out.
+
+   lyric_words(m): List of [word, time] with the words of midifile m.
+"""
+
+import re, json, bisect
+import midifile, catalog
+
+VERSION=1
+
+
+def _normalize(word):
+    return re.sub(r"[^\w']+",'',word.lower(),flags=re.UNICODE).strip("'")
+
+
+def lyric_words(m):
+    words=list()
+    current=list()
+    time0=0.
+    for [syl,t] in zip(m.karsyl,m.kartimes):
+        if syl == '/' or syl == '\\': # New line or page
+            syl=' '
+        for char in syl:
+            if char.isspace():
+                if len(current) > 0:
+                    words.append([''.join(current),time0])
+                    current=list()
+            else:
+                if len(current) == 0:
+                    time0=t
+                current.append(char)
+    if len(current) > 0:
+        words.append([''.join(current),time0])
+    return words
+
+
+class lyricindex(object):
+
+    def __init__(self):
+        self.songs=list() # Path of each song, None if removed
+        self.songids=dict()
+        self.postings=dict() # Flat lists of [song, position, time] per word
+        self.songwords=dict() # Set of the words of each song
+        self.vocabulary=None # Sorted words, for prefix search
+        return
+
+    def add_song(self,path,m):
+        if path in self.songids:
+            self.remove_song(path)
+        song=len(self.songs)
+        self.songs.append(path)
+        self.songids[path]=song
+        self.songwords[song]=set()
+        position=0
+        for [word,t] in lyric_words(m):
+            word=_normalize(word)
+            if word == '':
+                continue
+            if word not in self.postings:
+                self.postings[word]=list()
+                self.vocabulary=None
+            self.postings[word].extend([song,position,t])
+            self.songwords[song].add(word)
+            position=position+1
+        return
+
+    def add_file(self,path):
+        m=midifile.midifile()
+        m.load_file(path,lyricsonly=True)
+        self.add_song(path,m)
+        return
+
+    def remove_song(self,path):
+        song=self.songids.pop(path)
+        self.songs[song]=None
+        for word in self.songwords.pop(song): # Only its posting lists
+            p=self.postings[word]
+            p=[v for i in range(0,len(p),3) if p[i] != song for v in p[i:i+3]]
+            if len(p) == 0:
+                del self.postings[word]
+                self.vocabulary=None
+            else:
+                self.postings[word]=p
+        return
+
+    def _words(self,word,prefix):
+        if not prefix:
+            return [word]
+        if self.vocabulary == None:
+            self.vocabulary=sorted(self.postings)
+        i=bisect.bisect_left(self.vocabulary,word)
+        words=list()
+        while i < len(self.vocabulary) and self.vocabulary[i].startswith(word):
+            words.append(self.vocabulary[i])
+            i=i+1
+        return words
+
+    def search(self,phrase,prefix=False):
+        query=[_normalize(word) for word in phrase.split()]
+        query=[word for word in query if word != '']
+        if len(query) == 0:
+            return list()
+        # Places where each word of the query is found
+        places=list()
+        for iword in range(len(query)):
+            last=prefix and iword == len(query)-1
+            found=dict()
+            for word in self._words(query[iword],last):
+                p=self.postings.get(word,[])
+                for i in range(0,len(p),3):
+                    found[(p[i],p[i+1])]=p[i+2]
+            if len(found) == 0:
+                return list()
+            places.append(found)
+        hits=list()
+        for [[song,position],t] in places[0].items():
+            for iword in range(1,len(query)):
+                if (song,position+iword) not in places[iword]:
+                    break
+            else:
+                hits.append([self.songs[song],t])
+        hits.sort()
+        return hits
+
+    def save(self,filename):
+        f=open(filename,'w')
+        json.dump({'version':VERSION,'songs':self.songs,'postings':self.postings},f)
+        f.close()
+        return
+
+
+def load_index(filename):
+    f=open(filename)
+    data=json.load(f)
+    f.close()
+    if data.get('version') != VERSION:
+        raise ValueError('lyricindex version %s, expected %d' % (data.get('version'),VERSION))
+    index=lyricindex()
+    index.songs=data['songs']
+    index.songids=dict([[index.songs[i],i] for i in range(len(index.songs)) if index.songs[i] != None])
+    index.postings=data['postings']
+    for song in index.songids.values():
+        index.songwords[song]=set()
+    for [word,p] in index.postings.items():
+        for i in range(0,len(p),3):
+            index.songwords[p[i]].add(word)
+    return index
+
+
+def index_directory(directory):
+    index=lyricindex()
+    for path in catalog.find_songs(directory):
+        try:
+            index.add_file(path)
+        except Exception: # Damaged file
+            if path in index.songids:
+                index.remove_song(path)
+    return index
@@ -3,8 +3,646 @@
 # (c) 2015 Hector Socas-Navarro (hsocas.iac@gmail.com)
 #
 
-import struct, re
-class midifile:
+import struct, sys, os, math, time, mmap, array, bisect, heapq, itertools, threading, collections
+try:
+    import numpy
+except ImportError: # Only needed for the array versions of some methods
+    numpy=None
+
+PY3 = sys.version_info[0] >= 3
+MMAPSIZE = 16*1024*1024 # Files at least this big are memory-mapped
+DRUMS = 9 # Channel index of the percussion (MIDI channel 10)
+
+if PY3:
+    def _buffer(data): # Indexing returns ints, slicing does not copy
+        return memoryview(data)
+    def _text(data):
+        return bytes(data).decode('latin-1')
+    def _find(buf,sub,start,end):
+        if buf.nbytes == len(buf.obj): # Searched in place
+            return buf.obj.find(sub,start,end)
+        i=bytes(buf[start:end]).find(sub) # A slice of a bigger object
+        if i >= 0:
+            i=start+i
+        return i
+    _zip=zip
+else:
+    def _buffer(data):
+        return bytearray(data)
+    def _text(data):
+        return str(data)
+    def _find(buf,sub,start,end):
+        return buf.find(sub,start,end)
+    _zip=itertools.izip
+
+
+def _check_header(buf):
+    # Raises ValueError unless buf starts with the header of a MIDI file
+    if len(buf) < 14 or bytes(buf[0:4]) != b'MThd':
+        raise ValueError('Not a MIDI file (no MThd header)')
+
+
+def _read_vlq(buf,pos):
+    # Variable-length quantity starting at pos. Returns value and new offset
+    var=0
+    while True:
+        read=buf[pos]
+        pos=pos+1
+        var=(var<<7)|(read&0x7F)
+        if read < 0x80:
+            return var,pos
+
+
+def _track_events(buf,pos,end):
+    # Walks the events of the MTrk chunk in buf[pos:end] and yields
+    # [dtime,status,data1,data2,data] for each of them:
+    #  META events: status=0xFF, data1=meta type, data=raw bytes
+    #  Sysex events: status=0xF0 or 0xF7, data=raw bytes
+    #  MIDI messages: status (running status resolved), data1, data2
+    #   (data2 is None for program change and after-touch)
+    runningstatus=0
+    while pos < end:
+        read=buf[pos]
+        if read < 0x80: # Most delta times fit in one byte
+            dtime=read
+            pos=pos+1
+        else:
+            dtime,pos=_read_vlq(buf,pos)
+        status=buf[pos]
+        if status == 0xFF: # META event
+            metatype=buf[pos+1]
+            l,pos=_read_vlq(buf,pos+2)
+            yield [dtime,status,metatype,None,buf[pos:pos+l]]
+            pos=pos+l
+            if metatype == 0x2F: # End of track
+                return
+        elif status == 0xF0 or status == 0xF7: # Sysex event
+            l,pos=_read_vlq(buf,pos+1)
+            yield [dtime,status,None,None,buf[pos:pos+l]]
+            pos=pos+l
+        else: # MIDI messages
+            if status < 0x80: # Use running status instead
+                status=runningstatus
+            else:
+                pos=pos+1
+            runningstatus=status
+            if status & 0xE0 == 0xC0: # Program change or after-touch
+                yield [dtime,status,buf[pos],None,None]
+                pos=pos+1
+            else:
+                yield [dtime,status,buf[pos],buf[pos+1],None]
+                pos=pos+2
+
+
+def _write_vlq(var):
+    # Variable-length quantity encoding of var
+    out=bytearray([var&0x7F])
+    var=var>>7
+    while var > 0:
+        out.insert(0,(var&0x7F)|0x80)
+        var=var>>7
+    return out
+
+
+def _encode_events(events):
+    # MTrk chunk data for a list of [dtime,status,data1,data2,data] events
+    # like the ones of _track_events. Running status is used for
+    # consecutive MIDI messages with the same status
+    out=bytearray()
+    runningstatus=0
+    for [dtime,status,data1,data2,data] in events:
+        out+=_write_vlq(dtime)
+        if status == 0xFF: # META event
+            out.append(status)
+            out.append(data1)
+            out+=_write_vlq(len(data))
+            out+=data
+            runningstatus=0
+        elif status == 0xF0 or status == 0xF7: # Sysex event
+            out.append(status)
+            out+=_write_vlq(len(data))
+            out+=data
+            runningstatus=0
+        else: # MIDI messages
+            if status != runningstatus:
+                out.append(status)
+                runningstatus=status
+            out.append(data1)
+            if data2 != None:
+                out.append(data2)
+    return bytes(out)
+
+
+def _filter_track(buf,pos,end,patches2remove):
+    # Sets to zero the second data byte (velocity for notes) of the MIDI
+    # messages played with a patch in patches2remove. Returns the new
+    # track data, or None if nothing changed
+    currentpatch=0
+    changed=False
+    events=list()
+    for event in _track_events(buf,pos,end):
+        status=event[1]
+        if status < 0xF0:
+            if currentpatch in patches2remove and event[3]:
+                event[3]=0
+                changed=True
+            if status >> 4 == 0b1100: # Program change
+                currentpatch=event[2]
+        events.append(event)
+    if not changed:
+        return None
+    return _encode_events(events)
+
+
+def _absolute_events(buf,pos,end):
+    # Same as _track_events, with the absolute tick instead of dtime
+    tick=0
+    for [dtime,status,data1,data2,data] in _track_events(buf,pos,end):
+        tick=tick+dtime
+        yield [tick,status,data1,data2,data]
+
+
+def _cut_ticks(tempomap,t0,t1):
+    # Ticks of the time range [t0,t1) of write_file and write_variant
+    tick0=0
+    tick1=None
+    if t0 != None:
+        tick0=max(int(math.ceil(tempomap.sec2tick(t0)-1e-6)),0)
+    if t1 != None:
+        tick1=max(int(math.ceil(tempomap.sec2tick(t1)-1e-6)),tick0)
+    return [tick0,tick1]
+
+
+def _tempo_data(mpq,tempo):
+    # Tempo meta event data for mpq microseconds per quarter note, with
+    # the tempo multiplied by tempo
+    mpq=min(max(int(round(mpq/tempo)),1),0xFFFFFF)
+    return bytes(bytearray([mpq >> 16,(mpq >> 8) & 0xFF,mpq & 0xFF]))
+
+
+def _set_default_tempo(out,tempo):
+    # Adds the MIDI default tempo (scaled) at the start of the output
+    # events of a track, unless the track sets its own tempo there
+    for event in out:
+        if event[0] > 0:
+            break
+        if event[1] == 0xFF and event[2] == 0x51:
+            return
+    out.insert(0,[0,0xFF,0x51,None,_tempo_data(500000.,tempo)])
+    return
+
+
+def _variant_events(events,patches2remove,channels2remove,tick0,tick1,
+                    transpose=0,tempo=1.):
+    # Filters the (tick,status,data1,data2,data) events of a track as
+    # described in midifile.write_variant. Returns the output events as
+    # [dtime,status,data1,data2,data] and whether anything changed
+    out=list()
+    changed=False
+    currentpatch=0
+    active=set() # Notes sounding in the output, by (channel,pitch)
+    lasttick=0
+    for [tick,status,data1,data2,data] in events:
+        if tick1 != None and tick >= tick1:
+            changed=True
+            break
+        if status < 0xF0: # MIDI messages
+            if status >> 4 == 0b1100: # Program change
+                currentpatch=data1
+            if status & 0xF in channels2remove:
+                changed=True
+                continue
+            if currentpatch in patches2remove and data2:
+                data2=0
+                changed=True
+            if transpose != 0 and status < 0xB0 and status & 0xF != DRUMS: # Notes
+                data1=data1+transpose
+                changed=True
+                if data1 < 0 or data1 > 127: # Out of the MIDI range
+                    continue
+        elif status == 0xFF and data1 == 0x51 and tempo != 1 and len(data) == 3:
+            tt=struct.unpack('>BBB',data)
+            data=_tempo_data(tt[0]*65536.+tt[1]*256.+tt[2],tempo)
+            changed=True
+        elif status == 0xFF and data1 == 0x59 and transpose != 0 and len(data) == 2:
+            # Key signature: sharps (or -flats) move 7 per semitone
+            [sharps,mode]=struct.unpack('>bB',data)
+            sharps=(sharps+7*transpose+5)%12-5
+            data=struct.pack('>bB',sharps,mode)
+            changed=True
+        if tick < tick0: # Only the events that set the state are kept
+            changed=True
+            if status < 0xB0 or status >> 4 == 0b1101: # Notes and after-touch
+                continue
+            if status == 0xFF and (data1 == 0x5 or (data1 == 0x1 and data[:1] != b'@')):
+                continue # Lyrics already sung
+            tick=tick0
+        if status >> 4 == 0b1001 and data2 > 0:
+            active.add((status & 0xF,data1))
+        elif status >> 4 == 0b1000 or status >> 4 == 0b1001:
+            active.discard((status & 0xF,data1))
+        out.append([tick-tick0-lasttick,status,data1,data2,data])
+        lasttick=tick-tick0
+    else:
+        return [out,changed]
+    # Cut at tick1: the notes still sounding are switched off there
+    for [channel,pitch] in sorted(active):
+        out.append([tick1-tick0-lasttick,0x80|channel,pitch,0,None])
+        lasttick=tick1-tick0
+    out.append([tick1-tick0-lasttick,0xFF,0x2F,None,b''])
+    return [out,changed]
+
+
+def _karaoke_text(karsyl):
+    # Lyrics with a new line for '/' and an empty line for '\\'
+    text=list()
+    for syl in karsyl:
+        if syl == '/':
+            text.append('\n')
+        elif syl == '\\':
+            text.append('\n\n')
+        else:
+            text.append(syl)
+    return ''.join(text).strip('\n')
+
+
+# Event yielded by midifile.iter_events
+midievent=collections.namedtuple('midievent','kind tick time track channel data1 data2 data')
+_eventkinds={0b1000:'note_off',0b1001:'note_on',0b1010:'aftertouch',0b1011:'control_change',
+             0b1100:'program_change',0b1101:'channel_aftertouch',0b1110:'pitch_bend'}
+
+
+# Records of recordlist, for notes, patchesused and the tempo lists
+noterecord=collections.namedtuple('noterecord','pitch velocity channel patch track ton toff')
+patchrecord=collections.namedtuple('patchrecord','track patch time')
+temporecord=collections.namedtuple('temporecord','value time')
+_notetypes='BBBBHdd'
+_patchtypes='HBd'
+_tempotypes='dd'
+
+
+class recordlist(object):
+
+    """
+Compact version of the lists of lists used by midifile for notes,
+patchesused and the tempo lists. Each field is kept in an array (one
+machine number per value) instead of one Python list per element with
+one object per value, which takes several times less memory. Indexing
+returns a named tuple built on the fly (e.g., a noterecord, so that
+note[5] and note.ton are the same), so code that reads the elements of
+the original lists keeps working. Elements can't be changed in place.
+
+   recordlist(record, typecodes, rows=None, readonly=False): record is
+     the named tuple type of the elements and typecodes the array type
+     code of each field. rows is an optional sequence of elements to add.
+     If readonly is True, append, extend and sort raise AttributeError.
+
+ATTRIBUTES:
+
+     columns: The arrays, one per field
+
+METHODS:
+
+   len(), indexing, slicing (returns a list), iteration and comparison
+     with other sequences work as with a list. append(row), extend(rows)
+     and sort(key=None) too.
+"""
+
+    def __init__(self,record,typecodes,rows=None,readonly=False):
+        self.record=record
+        self.columns=[array.array(typecode) for typecode in typecodes]
+        self.readonly=False
+        if rows != None:
+            self.extend(rows)
+        self.readonly=readonly
+        return
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self.record._make([column[i] for column in self.columns])
+
+    def __iter__(self):
+        return itertools.starmap(self.record,_zip(*self.columns))
+
+    def __eq__(self,other):
+        if not hasattr(other,'__len__') or len(self) != len(other):
+            return False
+        for [a,b] in _zip(self,other):
+            if tuple(a) != tuple(b):
+                return False
+        return True
+
+    def __ne__(self,other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def _check(self):
+        if self.readonly:
+            raise AttributeError('read-only recordlist')
+
+    def append(self,row):
+        self._check()
+        for [column,value] in zip(self.columns,row):
+            column.append(value)
+        return
+
+    def extend(self,rows):
+        self._check()
+        for [column,values] in zip(self.columns,zip(*rows)):
+            column.extend(values)
+        return
+
+    def sort(self,key=None):
+        self._check()
+        rows=sorted(self,key=key)
+        self.columns=[array.array(column.typecode) for column in self.columns]
+        self.extend(rows)
+        return
+
+
+class tempomap:
+
+    """
+Tempo map of a MIDI file. The song is split in segments of constant
+tempo. For each segment the map keeps the tick at which it starts, the
+real time (in seconds) at that tick and the duration of one tick, so that
+any absolute tick is converted to real time with a binary search.
+
+   tempomap(division, tempos): division is the number of ticks per
+     quarter note and tempos is a list of [tick, microseconds per quarter
+     note] with the tempo changes, in any order. The MIDI default of 120
+     bpm is used until the first change.
+
+   tick2sec(tick): Real time in seconds of an absolute tick.
+
+   ticks2secs(ticks): Same as above for a sequence of ticks. Returns a
+     numpy array (or a list if numpy is not available).
+
+   sec2tick(sec): Inverse of tick2sec. Returns a float tick.
+"""
+
+    def __init__(self,division,tempos=None):
+        self.division=division
+        self.ticks=[0]
+        self.seconds=[0.]
+        self.secondspertick=[60./120/division] # Midi default
+        if tempos == None:
+            tempos=list()
+        for [tick,mpq] in sorted(tempos,key=lambda t: t[0]):
+            seconds=self.tick2sec(tick)
+            if tick == self.ticks[-1]: # Replaces tempo at this tick
+                self.secondspertick[-1]=mpq*1e-6/division
+                continue
+            self.ticks.append(tick)
+            self.seconds.append(seconds)
+            self.secondspertick.append(mpq*1e-6/division)
+        return
+
+    def tick2sec(self,tick):
+        i=bisect.bisect_right(self.ticks,tick)-1
+        return self.seconds[i]+(tick-self.ticks[i])*self.secondspertick[i]
+
+    def ticks2secs(self,ticks):
+        if numpy == None:
+            return [self.tick2sec(tick) for tick in ticks]
+        ticks=numpy.asarray(ticks,dtype=float)
+        i=numpy.searchsorted(self.ticks,ticks,side='right')-1
+        i=numpy.maximum(i,0)
+        return numpy.asarray(self.seconds)[i]+(ticks-numpy.asarray(self.ticks)[i])*numpy.asarray(self.secondspertick)[i]
+
+    def sec2tick(self,sec):
+        i=max(bisect.bisect_right(self.seconds,sec)-1,0)
+        return self.ticks[i]+(sec-self.seconds[i])/self.secondspertick[i]
+
+
+class midistats:
+
+    """
+Counters and timings of a midifile object, to find out why a file is
+slow. Nothing is recorded unless the stats attribute of the midifile
+object is set to a midistats object (before load_file, to record the
+parsing).
+
+   midistats(hook=None): hook is an optional function, called as
+     hook(name, stats) at the end of each phase of load_file, with name
+     'header', 'tracks' (after each track), 'tempo', 'times', 'lyrics' or
+     'load', and on each page change of the karaoke, with name 'page'.
+
+ATTRIBUTES:
+
+     timings: Dictionary with the time (in seconds) spent in each phase
+   of load_file: 'header' (reading the header and indexing the chunks),
+   'tracks' (decoding the events of all tracks and pairing note on and
+   off events), 'tempo' (building the tempo map), 'times' (converting
+   ticks to real time), 'lyrics' (indexing the karaoke pages) and 'load'
+   (the whole call). Decoding the tracks left by lyricsonly is added to
+   'tracks' and 'times'.
+
+     tracktimes: Dictionary with the time spent decoding each track
+
+     events: Dictionary with the number of events of each kind (same
+   kinds as midifile.iter_events, but META events other than tempo,
+   time signature and end of track are all counted as 'meta')
+
+     bytesread: Bytes of the file and bytes of the tracks decoded
+
+     notes: Number of notes, and how many of them were ended by a note
+   off event, by another note on (retriggered) or by the end of track
+
+     tempochanges: Number of tempo changes in the tempo map
+
+     karaokecalls, karaokepages, karaokelines: Number of calls to
+   update_karaoke, of page changes (by update_karaoke or seek_karaoke)
+   and of times the text of the lines was built
+
+METHODS:
+
+   as_dict(): Returns the attributes above (but hook) as a dictionary,
+     e.g. to save them as JSON.
+
+"""
+
+    def __init__(self,hook=None):
+        self.hook=hook
+        self.timings=dict()
+        self.tracktimes=dict()
+        self.events=dict()
+        self.bytesread={'file':0,'tracks':0}
+        self.notes={'total':0,'noteoff':0,'retriggered':0,'endoftrack':0}
+        self.tempochanges=0
+        self.karaokecalls=0
+        self.karaokepages=0
+        self.karaokelines=0
+        return
+
+    def phase(self,name,seconds):
+        self.timings[name]=self.timings.get(name,0.)+seconds
+        if self.hook != None:
+            self.hook(name,self)
+        return
+
+    def count_events(self,events):
+        # Passes the events of _track_events through, counting them
+        counts=self.events
+        for event in events:
+            status=event[1]
+            if status == 0xFF:
+                kind={0x51:'tempo',0x58:'time_signature',0x2F:'end_of_track'}.get(event[2],'meta')
+            elif status == 0xF0 or status == 0xF7:
+                kind='sysex'
+            elif status >> 4 == 0b1001 and event[3] == 0:
+                kind='note_off'
+            else:
+                kind=_eventkinds[status >> 4]
+            counts[kind]=counts.get(kind,0)+1
+            yield event
+
+    def as_dict(self):
+        return {'timings':dict(self.timings),'tracktimes':dict(self.tracktimes),
+                'events':dict(self.events),'bytesread':dict(self.bytesread),
+                'notes':dict(self.notes),'tempochanges':self.tempochanges,
+                'karaokecalls':self.karaokecalls,'karaokepages':self.karaokepages,
+                'karaokelines':self.karaokelines}
+
+
+class playbackcursor(object):
+
+    """
+Playback state of the karaoke of a song: the syllable being sung and the
+lines displayed. midifile objects have their own one, so only one
+playback may use them at a time. For more listeners of the same song,
+make a song object with song(m) and get a cursor for each one with its
+cursor() method. Cursors only keep references to the (read-only) data of
+the song, so many of them may be used at the same time, each one from its
+own thread, without locks.
+
+   playbackcursor(song): Cursor at the start of the song.
+
+ATTRIBUTES:
+
+     karlinea, karlineb, karidx, karievent0, karievent1: As in midifile
+
+     song: The song object
+
+     karfile, kartrack, karsyl, kartimes: Those of the song
+
+METHODS:
+
+   update_karaoke(dt), seek_karaoke(dt): As in midifile
+"""
+
+    def __init__(self,song):
+        self.song=song
+        self.stats=None
+        self._reset_cursor()
+        for name in ['karfile','kartrack','karsyl','kartimes','_kartext','_karoffsets',
+                     '_karseps','_karend','_karpagestarts','_karpages']:
+            setattr(self,name,getattr(song,name))
+        return
+
+    def _reset_cursor(self):
+        self.karlinea=['']*3
+        self.karlineb=['']*3
+        self.karievent0=[-1]*3
+        self.karievent1=[-1]*3
+        self.karidx=0
+        self._karstate=None
+        self._kardt=0.
+
+
+    def _kartext_range(self,i0,i1):
+        # Text of syllables i0 to i1, both included
+        return self._kartext[self._karoffsets[i0]:self._karoffsets[i1+1]]
+
+
+    def update_karaoke(self, dt):
+        if self.stats != None:
+            self.stats.karaokecalls+=1
+        if not self.karfile or self.kartrack == 0 or len(self.karsyl) == 0:
+            return
+        if dt < self._kardt: # Jumped back
+            return self.seek_karaoke(dt)
+        self._kardt=dt
+        if self.karidx >= len(self.karsyl)-1:
+            return
+        # First syllable at or after dt, then back one
+        idx=bisect.bisect_left(self.kartimes,dt,self.karidx)
+        self.karidx=max(min(idx,len(self.kartimes)-1)-1,0)
+        if self.karidx == self.karievent1[2]: # If reached the end of 3 lines,
+            self.karidx=self.karidx+1 # Make sure next 3 lines are displayed
+        self.karidx=min(self.karidx,len(self.kartimes)-1)
+        if self.karidx > self.karievent1[2]: # Load next three lines
+            return self.seek_karaoke(dt)
+        self._karaoke_lines(dt >= self._karend)
+        return False
+
+
+    def seek_karaoke(self, dt):
+        if not self.karfile or self.kartrack == 0 or len(self.karsyl) == 0:
+            return
+        self._kardt=dt
+        idx=bisect.bisect_left(self.kartimes,dt)
+        self.karidx=max(min(idx,len(self.kartimes)-1)-1,0)
+        ipage=bisect.bisect_right(self._karpagestarts,self.karidx)-1
+        if self.karidx == self._karpages[ipage][1][2]: # End of 3 lines
+            self.karidx=min(self.karidx+1,len(self.kartimes)-1)
+            ipage=bisect.bisect_right(self._karpagestarts,self.karidx)-1
+        [karievent0,karievent1]=self._karpages[ipage]
+        if self.stats != None and karievent0[0] != self.karievent0[0]:
+            self.stats.karaokepages+=1
+            if self.stats.hook != None:
+                self.stats.hook('page',self.stats)
+        self.karievent0=list(karievent0)
+        self.karievent1=list(karievent1)
+        self._karstate=None
+        self._karaoke_lines(dt >= self._karend)
+        return False
+
+
+    def _karaoke_lines(self, songend):
+        # Sets karlinea and karlineb for the current syllable and page
+        if self._karstate == [self.karidx,self.karievent0[0],songend]: # Nothing changed
+            return
+        self._karstate=[self.karidx,self.karievent0[0],songend]
+        if self.stats != None:
+            self.stats.karaokelines+=1
+
+        for iline in range(3):
+            e0=self.karievent0[iline]
+            e1=self.karievent1[iline]
+            if e0 == e1:
+                self.karlinea[iline]=''
+                self.karlineb[iline]=''
+                continue
+            # Colored text
+            if self.karidx < e0:
+                self.karlinea[iline]=''
+            else:
+                self.karlinea[iline]=self._kartext_range(e0,min(self.karidx,e1))
+            # White text
+            i0=max(self.karidx+1,e0)
+            if i0 > e1:
+                self.karlineb[iline]=''
+            else:
+                self.karlineb[iline]=self._kartext_range(i0,e1)
+
+        # Special case for song end
+        if songend:
+            for iline in range(-2,1):
+                if self.karlinea[iline] != '':
+                    self.karlinea[iline]=self._kartext_range(self.karievent0[iline],len(self.karsyl)-1)
+                    self.karlineb[iline]=''
+                    break
+        return False
+
+
+class midifile(playbackcursor):
 
     # Used specs from http://www.midi.org/techspecs/midimessages.php
     # http://www.blitter.com/~russtopia/MIDI/~jglatt/tech/midifile.htm
@@ -20,7 +658,12 @@ are defined:
 
 ATTRIBUTES:
 
-        fileobject: A file type associated to the .mid or .kar file
+        fileobject: A file type associated to the .mid or .kar file. The
+      methods that read a file take a filename, a file object (e.g., a
+      member of a zip or tar archive, see songpack.py) or an mmap object
+      or memoryview with the file (e.g., a song of a song pack), which is
+      parsed in place. It's left open: with lyricsonly or background it
+      is used until the other tracks are decoded
 
         error : Error condition upon exit from the class methods. It's False
       if no error or some other type depending on the error condition
@@ -44,6 +687,14 @@ ATTRIBUTES:
 	num=[[4, 0.]] # Midi default
 
     	den=[[4, 0.]] # Midi default
+
+        division=Number of ticks per quarter note
+
+        tempomap=A tempomap object built from the tempo changes found in
+     all the tracks. It converts absolute ticks to real time (see the
+     tempomap class). All real times below are computed with it, so a
+     tempo change in one track (e.g., the conductor track of a format 1
+     file) applies to the events of every track.
     
     For karaoke .kar files
     	karfile=Boolean that indicates whether the file has karaoke 
@@ -72,6 +723,29 @@ ATTRIBUTES:
 
        tracknames=List of strings with the names of each track
 
+       duration=Real time (in seconds) at which the last track ends. With
+     lyricsonly=True it only covers the tracks decoded so far
+
+       trackindex=List with the offset (in bytes, from the beginning of
+     the file) and length of the MTrk chunk of each track
+
+       events=None, unless load_file was run with keepevents=True. Then
+     it is a list with the events of each track. Each event is a tuple
+     (tick, status, data1, data2, data), where tick is the absolute tick,
+     status is the status byte (with the channel for MIDI messages), data1
+     and data2 the data bytes (data2 is None for program change and
+     after-touch) and, for META (status 0xFF, data1 is the type) and Sysex
+     events, data has the raw bytes. The lists may be edited, keeping the
+     events in tick order, before calling write_variant
+
+    Instrumentation
+       stats=None by default. If it is set to a midistats object (see
+     that class) before calling load_file, the object records the time
+     spent in each phase of the parsing, the number of events of each
+     kind, bytes read, note pairing counts and the update_karaoke calls
+     and page changes. It may also call a hook function at the end of
+     each phase. With stats=None nothing is recorded
+
     MIDI note information 
        patchesused=A list of lists, each element
        containing the patches (instruments) used in the file, the
@@ -84,12 +758,12 @@ ATTRIBUTES:
      time_start and time_end are real time in seconds. Time_end
      is the time in which a note_off event (or a note_on with 0 velocity)
      was registered for this note. Some notes may not have an associated
-     note_off event, in which case, time_end is set to -1. If two
-     note_on events are registered for the same note without a note_off
-     event in between, then the time_end for the first note is set to
-     the time_start of the second note. Note on and note off matching is 
-     done across tracks but not across patches, so a piano C4 is not 
-     considered the same note as a guitar C4.
+     note_off event, in which case, time_end is set to the time at which
+     their track ends. If two note_on events are registered for the same
+     note without a note_off event in between, then the time_end for the
+     first note is set to the time_start of the second note. Note on and
+     note off matching is done within each track and channel, so a C4 in
+     one channel is not considered the same note as a C4 in another one.
 
 
 METHODS:
@@ -98,22 +772,122 @@ METHODS:
 
    load_file() : This method parses the .mid or .kar file and sets
      the corresponding class attributes. Should be called before
-     using any of the attributes.
+     using any of the attributes. The argument may be a filename or
+     a file object. The file is read in one go (files larger than
+     MMAPSIZE bytes are memory-mapped) and then parsed in memory. A file
+     that doesn't start with a MIDI header raises ValueError, here and in
+     iter_events and write_file.
+     load_file(fileobject, lyricsonly=True) is a faster mode for
+     karaoke players. Only the conductor track (the first one), the
+     karaoke tracks and the tracks with tempo changes or time signatures
+     are parsed, so karsyl, kartimes and the tempo attributes are ready on
+     return. The other tracks are decoded the first time notes,
+     patchesused or tracknames are used.
+     load_file(fileobject, keepevents=True) also keeps the events of
+     every track (see the events attribute) and the original bytes of the
+     file, so that write_variant can write several versions of the song
+     without reading it again.
+     load_file(fileobject, background=True) parses the same tracks as
+     lyricsonly and returns, so the karaoke can start, while the other
+     tracks are decoded in a background thread. notes and patchesused
+     grow as each track is decoded (they can be read from other threads
+     at any time, and only hold notes already timed in seconds) and are
+     sorted by track at the end. Use wait_loaded() to wait for all of
+     them.
+
+   wait_loaded(timeout=None): Waits until the tracks left by load_file
+     with background=True are decoded (or decodes those left by
+     lyricsonly). Returns False if timeout (in seconds) expired first,
+     True otherwise. If the background thread failed, its exception is
+     raised here (it is also kept in the loaderror attribute).
+
+   iter_events(fileobject): Generator that yields the events of a
+     .mid or .kar file (filename or file object) in time order, merging
+     all the tracks as it goes, so the whole song is never materialized.
+     Each event is a midievent named tuple with the fields kind, tick,
+     time (real time in seconds), track, channel (MIDI messages only),
+     data1, data2 and data. kind is one of 'note_on', 'note_off',
+     'aftertouch', 'control_change', 'program_change',
+     'channel_aftertouch', 'pitch_bend', 'sysex', 'tempo' (data2 is the
+     new microseconds per quarter note), 'time_signature', 'lyric' (data
+     is the text), 'text', 'end_of_track' or 'meta' (any other META
+     event, data1 is the type and data the raw bytes).
+
+   get_notetable(): Returns the notes in a notetable object, with one
+     numpy array per field instead of one list per note, plus some
+     vectorized queries (see notetable.py). Requires: numpy.
+
+   compact(): Replaces notes, patchesused, bpm,
+     microsecondsperquarternote, num and den by recordlist objects, which
+     keep each field in an array and take several times less memory (for
+     notes, about 22 bytes per note instead of about 150). Reading them
+     works as before: note[5] is the start time of a note (also note.ton,
+     see noterecord), and they can be iterated, sliced and appended to,
+     but their elements can't be changed in place. Returns the object
+     itself.
 
    update_karaoke(dt): The input argument dt is a float with the time
      in seconds elapsed since the start of the song. This method then
      checks the karaoke information and updates the related attributes 
      (particularly karlinea and karlineb) so that they can be used
-     by the caller. Need to have run load_file() before.
+     by the caller. Need to have run load_file() before. dt may jump
+     forwards or backwards (e.g., to restart a verse or to resume a
+     paused song), in which case the lines are set as in seek_karaoke.
+
+   karaoke_text(): Returns the lyrics of a .kar file as a string, with
+     a new line at the end of each line and an empty line between pages.
+
+   seek_karaoke(dt): Sets karlinea and karlineb (and the internal
+     cursor) to what they would be at time dt if the song had been
+     played from the start, without rescanning the lyrics.
+
+   write_file(filein, fileout, tracks2remove, patches2remove,
+     transpose=0, tempo=1., t0=None, t1=None): This method replicates a
+     MIDI or karaoke file with the option to supress one or more tracks
+     and/or instruments. filein and fileout are strings with the
+     corresponding filenames (filein must exist and fileout will be
+     overwritten). tracks2remove and patches2remove may be either None
+     or a list (can be an empty list) of integers with the numbers of
+     tracks or instruments that are not wanted in the output file. The
+     notes of the removed instruments are kept with zero velocity.
+     transpose is the number of semitones to shift the notes (and the key
+     signature), except those of the drums (channel index 9); notes that
+     go out of the MIDI range are left out. tempo multiplies the tempo
+     (e.g., 1.1 is 10% faster). t0 and t1 cut the song as in
+     write_variant (in seconds of the original tempo). The tracks are
+     transformed one by one as they are read, without parsing the song.
+     Tracks with nothing to change are copied byte by byte; the others
+     are encoded again.
+
+   write_variant(fileout, tracks2remove=None, patches2remove=None,
+     channels2remove=None, t0=None, t1=None, transpose=0, tempo=1.):
+     Writes a version of the file loaded with keepevents=True to fileout
+     (a filename or a file object), from the events attribute.
+     tracks2remove, patches2remove, transpose and tempo are as in
+     write_file. channels2remove is a list of MIDI channels (0 to 15,
+     e.g. 9 for the drums) whose messages are left out. t0 and t1 (in
+     seconds) cut the song to that time range: the tempo, patches,
+     controllers, etc. set before t0 are moved to the start and the notes
+     still sounding at t1 are switched off. Tracks with nothing to change
+     and whose events were not edited are copied from the original bytes.
+
+
+SHARED SONGS:
+
+     A midifile object holds both the parsed song and the state of one
+     karaoke playback (karidx, karlinea, karlineb...), so it can't be
+     played by several listeners at once. song(m) makes a read-only copy
+     of the parsed data of m (with tuples and recordlists instead of
+     lists, as compact() does) that can be shared by any number of
+     threads, and song.cursor() returns a playbackcursor object with its
+     own update_karaoke, seek_karaoke, karlinea, karlineb, etc. for each
+     listener:
+
+s=midifile.song(m)
+cursor=s.cursor()
+cursor.update_karaoke(15)
+print cursor.karlinea[0]+'__'+cursor.karlineb[0]
 
-   write_file(filein, fileout, tracks2remove, patches2remove): This
-     method replicates a MIDI or karaoke file with the option to
-     supress one or more tracks and/or instruments. filein and fileout
-     are strings with the corresponding filenames (filein must exist and
-     fileout will be overwritten). tracks2remove and patches2remove may
-     be either None or a list (can be an empty list) of integers with
-     the numbers of tracks or instruments that are not wanted in the
-     output file.
 
 
 
@@ -145,6 +919,20 @@ print m.karlinea[0]+'__'+m.karlineb[0]
         self.fileobject=None
         self.closeonreturn=False
         self.error=False
+        self.division=0 # Ticks per quarter note
+        self.tempomap=None
+        self.trackindex=list() # Offset and length of each MTrk chunk
+        self._pending=list() # Tracks not decoded yet
+        self._lazybuffer=None
+        self._loader=None # Fills notes, patchesused and tracknames when set
+        self._worker=None # Thread decoding tracks, with background=True
+        self.loaderror=None # Exception raised by that thread
+        self._notecolumns=None # Arrays with the notes, if read from a cache
+        self.events=None # Events of each track, with keepevents=True
+        self._original=None # Events of each track as parsed
+        self._chunks=None # Header and chunks, with the tracks by number
+        self._rawtracks=None # Original MTrk chunk of each track
+        self.stats=None # midistats object, to record counters and timings
         # Tempo and real time at which it was set
         self.bpm=[[120,0.]] # bpm using actual time signature
         self.microsecondsperquarternote=[[60000000./120,0.]]
@@ -155,13 +943,11 @@ print m.karlinea[0]+'__'+m.karlineb[0]
         self.kartrack=0
         self.karsyl=list()
         self.kartimes=list()
-        self.karlinea=['']*3
-        self.karlineb=['']*3
-        self.karievent0=[-1]*3
-        self.karievent1=[-1]*3
-        self.karidx=0
+        self._reset_cursor()
         # Track information
         self.ntracks=0
+        self.duration=0.
+        self._endtick=0
         self.tracknames=list()
         # Note information
         self.patchesused=list()
@@ -184,412 +970,776 @@ print m.karlinea[0]+'__'+m.karlineb[0]
         return [var,iread,bytesread] # Return value and number of bytes read
 
 
-    def load_file(self,fileobject):
+    def load_file(self,fileobject,lyricsonly=False,keepevents=False,background=False):
         
+        if self.stats != None:
+            t0=time.time()
+        [buf,source]=self._open_buffer(fileobject)
+        if self.stats != None:
+            self.stats.bytesread['file']+=len(buf)
+        try:
+            _check_header(buf)
+            if keepevents:
+                self._keep_chunks(buf)
+            self._parse_buffer(buf,lyricsonly or background)
+        except:
+            self._pending=list()
+            raise
+        finally:
+            if self.closeonreturn:
+                self.fileobject.close()
+            if len(self._pending) == 0:
+                self._close_buffer(buf,source)
+            elif background:
+                self._worker=threading.Thread(target=self._decode_background,args=[buf,source])
+                self._worker.daemon=True
+                self._worker.start()
+            else: # Keep the data until the other tracks are decoded
+                self._lazybuffer=[buf,source]
+                self._loader=self._decode_pending
+        if self.stats != None:
+            self.stats.phase('load',time.time()-t0)
+        return self.error
+
+
+    def _timed(self,name,function,*args):
+        # Runs function, adding its time to the stats of phase name
+        if self.stats == None:
+            return function(*args)
+        t0=time.time()
+        result=function(*args)
+        self.stats.phase(name,time.time()-t0)
+        return result
+
+
+    def _open_buffer(self,fileobject):
+        # Read the whole file once. Big files on disk are memory-mapped
+        # instead so that nothing is copied until an event needs it
         if type(fileobject) == str:
             self.fileobject=open(fileobject,'rb')
             self.closeonreturn=True
         else:
             self.fileobject=fileobject
-
-        headerid=str(self.fileobject.read(4))
-        headerlen=struct.unpack('>I',self.fileobject.read(4))[0] # > is for big-endian, i for integer
-        fileformat=struct.unpack('>H',self.fileobject.read(2))[0]
-        self.ntracks=struct.unpack('>H',self.fileobject.read(2))[0]
-        self.tracknames=['']*self.ntracks
-        division=struct.unpack('>h',self.fileobject.read(2))[0] # Ticks per quarter note
+            self.closeonreturn=False
+        if isinstance(fileobject,(mmap.mmap,memoryview)): # Parsed in place
+            return [_buffer(fileobject),None] # Closed by the caller
+        source=None
+        if PY3 and self.closeonreturn:
+            size=os.fstat(self.fileobject.fileno()).st_size
+            if size >= MMAPSIZE:
+                source=mmap.mmap(self.fileobject.fileno(),0,access=mmap.ACCESS_READ)
+        if source == None:
+            source=self.fileobject.read()
+        return [_buffer(source),source]
+
+
+    def _close_buffer(self,buf,source):
+        # source is None if the caller passed the buffer, which is not closed
+        if PY3:
+            buf.release()
+        if isinstance(source,mmap.mmap):
+            source.close()
+
+
+    def _parse_buffer(self,buf,lyricsonly=False):
+        if self.stats != None:
+            t0=time.time()
+        [headerlen,fileformat,self.ntracks,division]=struct.unpack_from('>IHHh',buf,4)
+        self._tracknames=['']*self.ntracks
         if division < 0: # It's a different format SMTPE
             self.error=1
-            if self.closeonreturn:
-                self.fileobject.close()
             return self.error
+        self.division=division
+
+        self.trackindex=list()
+        pos=8+headerlen
+        while len(self.trackindex) < self.ntracks and pos+8 <= len(buf):
+            trackid=bytes(buf[pos:pos+4])
+            tracklen=struct.unpack_from('>I',buf,pos+4)[0]
+            pos=pos+8
+            end=min(pos+tracklen,len(buf))
+            if trackid == b'MTrk': # Unknown chunks must be ignored
+                self.trackindex.append([pos,end-pos])
+            pos=end
+        if self.stats != None:
+            self.stats.phase('header',time.time()-t0)
+
+        tracks=list(range(len(self.trackindex)))
+        if lyricsonly:
+            tracks=self._lyric_tracks(buf)
+            self._pending=[itrack for itrack in range(len(self.trackindex)) if itrack not in tracks]
+
+        # All events are timed in ticks first. Real times are set once the
+        # tempo changes of every track are known
+        tempoevents=list()
+        if self._chunks != None:
+            self.events=[list() for itrack in self.trackindex]
+            self._original=[None]*len(self.trackindex)
+        for itrack in tracks:
+            [pos,tracklen]=self.trackindex[itrack]
+            self._parse_track(buf,pos,pos+tracklen,itrack,tempoevents)
+        self._timed('tempo',self._set_tempo,tempoevents)
+        if self.stats != None:
+            self.stats.tempochanges=len(self.tempomap.ticks)-1
+        self._timed('times',self._ticks2seconds,0,0)
+        self._timed('lyrics',self._index_lyrics)
+        return self.error
 
-        for itrack in range(self.ntracks):
-            currentpatch=0
-            mastertime=0
-            trackid=str(self.fileobject.read(4))
-            tracklen=struct.unpack('>I',self.fileobject.read(4))[0]
-            # track event
-            metatype=0
-            iread=0
-            while iread < tracklen and metatype != 0x2f:
-                [dtime,nbytesread,bytesread]=self.read_var_length()
-                iread=iread+nbytesread
-                # Midi event
-                status=struct.unpack('>B',self.fileobject.read(1))[0]
-                iread=iread+1
-
-                # Set timing conversion. Find tempo for previous event at mastertime
-                i0=len(self.microsecondsperquarternote)-1
-                while (self.microsecondsperquarternote[i0][1]) > mastertime:
-                    i0=i0-1
-                # Try with that tempo
-                tickspermicrosecond=division/self.microsecondsperquarternote[i0][0]
-                secondspertick=1./tickspermicrosecond*1e-6
-                dtimesec=dtime*secondspertick
-                # Check if there has been a tempo change in that interval
-                i1=len(self.microsecondsperquarternote)-1
-                while (self.microsecondsperquarternote[i1][1]) > mastertime+dtimesec:
-                    i1=i1-1
-                if i1 != i0: # Tempo has changed. Recompute using MIDI steps
-                    tickspermicrosecond=division/self.microsecondsperquarternote[i0][0]
-                    secondspertick0=1./tickspermicrosecond*1e-6
-                    tickspermicrosecond=division/self.microsecondsperquarternote[i1][0]
-                    secondspertick1=1./tickspermicrosecond*1e-6
-                    dtimesec=0.
-                    for itick in range(dtime):
-                        if mastertime+dtimesec <  self.microsecondsperquarternote[i1][1]:
-                            dtimesec=dtimesec+secondspertick0
-                        else:
-                            dtimesec=dtimesec+secondspertick1
-
-
-                else: # No tempo change. Proceed with value at i0            
-                    tickspermicrosecond=division/self.microsecondsperquarternote[i0][0]
-                    secondspertick=1./tickspermicrosecond*1e-6
-                    dtimesec=dtime*secondspertick
-
-                mastertime=mastertime+dtimesec
-
-                if status == 0xFF: # It's a non-MIDI event, META event
-                    metatype=struct.unpack('>B',self.fileobject.read(1))[0]
-                    iread=iread+1
-                    [l,nb,bytesread]=self.read_var_length()
-                    iread=iread+nb
-                    data=self.fileobject.read(l)
-                    iread=iread+l
-                    if metatype == 0x51: # Set tempo
-                        tt=struct.unpack('>BBB',data)
-                        self.microsecondsperquarternote.append([tt[0]*65536.+tt[1]*256.+tt[2],mastertime])
-                        self.bpm.append([60000000. / self.microsecondsperquarternote[-1][0] * (self.den[-1][0] / self.num[-1][0]), mastertime])
-                        self.num.append([self.num[-1][0], mastertime])
-                        self.den.append([self.den[-1][0], mastertime])
-                    if metatype == 0x58: # Time signature
-                        d=struct.unpack('>BBBB',data)
-                        self.num.append([float(d[0]),mastertime])
-                        self.den.append([float(d[1]**2),mastertime])
-                        self.microsecondsperquarternote.append([self.microsecondsperquarternote[-1][0], mastertime])
-                        self.bpm.append([self.bpm[-1][0], mastertime])
-                    if metatype == 0x1:
-                        if data == '@KMIDI KARAOKE FILE':
-                            self.karfile=True
-                            self.kartrack=itrack+1
-                        if self.karfile and itrack == self.kartrack:
-                            if data[0] != '@':
-                                if '\\' in data:
-                                    self.karsyl.append('\\')
-                                    self.kartimes.append(mastertime)
-                                    data=re.sub('\\\\','',data)
-                                if '/' in data:
-                                    self.karsyl.append('/')
-                                    self.kartimes.append(mastertime)
-                                    data=re.sub('/','',data)
-                                self.karsyl.append(data)
-                                self.kartimes.append(mastertime)    
-                    if metatype == 0x3: # Track name
-                        self.tracknames[itrack]=data
-                    if metatype == 0x2F: # End of track
-                        pass 
-
-                elif status == 0xF0 or status == 0xF7: # Now a Sysex event
-                    [l,nb,bytesread]=self.read_var_length()
-                    iread=iread+nb
-                    data=self.fileobject.read(l)
-                    iread=iread+l
 
-                else: # MIDI messages
-                    if status < 128: # Use running status instead
-                        status=runningstatus
-                        self.fileobject.seek(-1,1)
-                        iread=iread-1
-                    status1 = status / 16
-                    status2 = status % 16
-                    channel=status2
-                    if status1 == 0b1100: # Program change
-                        read=struct.unpack('>B',self.fileobject.read(1))[0]
-                        currentpatch=read
-                        self.patchesused.append([itrack,currentpatch,mastertime])
-                        iread=iread+1
-                    elif status1 == 0b1101: # After-touch
-                        read=struct.unpack('>B',self.fileobject.read(1))[0]
-                        iread=iread+1
-                    else:
-                        data1=struct.unpack('>B',self.fileobject.read(1))[0]
-                        data2=struct.unpack('>B',self.fileobject.read(1))[0]
-                        iread=iread+2
-                    if status1 == 0b1001 and data2 > 0: # Note on event
-                        self.notes.append([data1,data2,status2,currentpatch,itrack,mastertime,-1])
-                        inote=len(self.notes)-1 # If it was previously on, count it off
-                        while inote >= 0:
-                            if self.notes[inote][0] == data1 and self.notes[inote][2] == currentpatch:
-                                self.notes[inote][5] == mastertime # Time note off
-                                break
-                            inote=inote-1
-                    elif status1 == 0b1000 or (status1 == 0b1001 and data2 == 0): # Note off event
-                        inote=len(self.notes)-1
-                        while inote >= 0:
-                            if self.notes[inote][0] == data1 and self.notes[inote][2] == currentpatch:
-                                self.notes[inote][5] == mastertime # Time note off
-                                break
-                            inote=inote-1
-                    runningstatus=status
-                # End MIDI event
+    def _keep_chunks(self,buf):
+        # Keeps the header and the chunks that are not tracks as bytes and
+        # the original data of the tracks, for write_variant
+        [headerlen,fileformat,ntracks,division]=struct.unpack_from('>IHHh',buf,4)
+        self._chunks=[bytes(buf[0:8+headerlen])]
+        self._rawtracks=list()
+        pos=8+headerlen
+        while pos+8 <= len(buf):
+            trackid=bytes(buf[pos:pos+4])
+            tracklen=struct.unpack_from('>I',buf,pos+4)[0]
+            end=min(pos+8+tracklen,len(buf))
+            if trackid != b'MTrk' or len(self._rawtracks) >= ntracks: # Not a track
+                self._chunks.append(bytes(buf[pos:end]))
+            else:
+                self._chunks.append(len(self._rawtracks))
+                self._rawtracks.append(bytes(buf[pos:end]))
+            pos=end
+
+
+    def _lyric_tracks(self,buf):
+        # Conductor track plus the tracks with the karaoke header and text
+        # and any other track with tempo changes or time signatures, which
+        # are needed for the times of the lyrics
+        tracks=[0]
+        for itrack in range(len(self.trackindex)):
+            [pos,tracklen]=self.trackindex[itrack]
+            if _find(buf,b'@KMIDI KARAOKE FILE',pos,pos+tracklen) >= 0:
+                tracks=tracks+[itrack,itrack+1]
+            if (_find(buf,b'\xFF\x51\x03',pos,pos+tracklen) >= 0 or
+                _find(buf,b'\xFF\x58\x04',pos,pos+tracklen) >= 0):
+                tracks.append(itrack)
+        return sorted(set(tracks) & set(range(len(self.trackindex))))
+
+
+    def _decode_pending(self):
+        # Decodes the tracks skipped by a lyricsonly load_file
+        [buf,source]=self._lazybuffer
+        pending=self._pending
+        self._pending=list()
+        self._lazybuffer=None
+        n0notes=len(self._notes)
+        n0patches=len(self._patchesused)
+        try:
+            for itrack in pending:
+                [pos,tracklen]=self.trackindex[itrack]
+                # The tempo map is already set: the tracks with tempo
+                # changes were parsed on load
+                self._parse_track(buf,pos,pos+tracklen,itrack,list())
+        finally:
+            self._close_buffer(buf,source)
+        self._timed('times',self._ticks2seconds,n0notes,n0patches)
+        self._notes.sort(key=lambda note: note[4])
+        self._patchesused.sort(key=lambda patch: patch[0])
+        return
 
 
+    def _decode_background(self,buf,source):
+        # Runs in the worker thread of load_file(..., background=True).
+        # Each track is decoded apart and its notes and patches are added
+        # to the lists once their times are in seconds. Adding to a list
+        # is atomic, so readers see either the old or the new contents
+        pending=self._pending
+        self._pending=list()
+        try:
+            for itrack in pending:
+                [pos,tracklen]=self.trackindex[itrack]
+                notes=list()
+                patches=list()
+                self._parse_track(buf,pos,pos+tracklen,itrack,list(),notes,patches)
+                self._timed('times',self._convert_times,notes,patches)
+                self._notes.extend(notes)
+                self._patchesused.extend(patches)
+                self.duration=self.tempomap.tick2sec(self._endtick)
+            # Same order as a full load_file. The sorted lists replace the
+            # old ones at once
+            self._notes=sorted(self._notes,key=lambda note: note[4])
+            self._patchesused=sorted(self._patchesused,key=lambda patch: patch[0])
+        except Exception as e:
+            self.loaderror=e
+        finally:
+            self._close_buffer(buf,source)
+        return
+
+
+    def wait_loaded(self,timeout=None):
+        if self._loader != None:
+            self._load()
+        if self._worker != None:
+            self._worker.join(timeout)
+            if self._worker.is_alive():
+                return False
+            self._worker=None
+        if self.loaderror != None:
+            raise self.loaderror
+        return True
+
+
+    def _load(self):
+        loader=self._loader
+        self._loader=None
+        loader()
+
+
+    def _get_notes(self):
+        if self._loader != None:
+            self._load()
+        return self._notes
+
+    def _set_notes(self,notes):
+        self._notes=notes
+
+    notes=property(_get_notes,_set_notes)
+
+    def _get_patchesused(self):
+        if self._loader != None:
+            self._load()
+        return self._patchesused
+
+    def _set_patchesused(self,patchesused):
+        self._patchesused=patchesused
+
+    patchesused=property(_get_patchesused,_set_patchesused)
+
+    def _get_tracknames(self):
+        if self._loader != None:
+            self._load()
+        return self._tracknames
+
+    def _set_tracknames(self,tracknames):
+        self._tracknames=tracknames
+
+    tracknames=property(_get_tracknames,_set_tracknames)
+
+
+    def _parse_track(self,buf,pos,end,itrack,tempoevents,notes=None,patches=None):
+        # Notes and patch changes go to the given lists (by default, those
+        # of notes and patchesused) with their times in ticks
+        if notes == None:
+            notes=self._notes
+        if patches == None:
+            patches=self._patchesused
+        currentpatch=0
+        tick=0
+        active=dict() # Notes sounding in this track, by (channel,pitch)
+        retriggered=0
+        events=None
+        if self.events != None:
+            events=self.events[itrack]
+        trackevents=_track_events(buf,pos,end)
+        if self.stats != None:
+            t0=time.time()
+            n0notes=len(notes)
+            trackevents=self.stats.count_events(trackevents)
+        for [dtime,status,data1,data2,data] in trackevents:
+            tick=tick+dtime
+            if events != None:
+                if data != None:
+                    data=bytes(data)
+                events.append((tick,status,data1,data2,data))
+
+            if status == 0xFF: # It's a non-MIDI event, META event
+                metatype=data1
+                if metatype == 0x51: # Set tempo
+                    tt=struct.unpack('>BBB',data)
+                    tempoevents.append([tick,metatype,tt[0]*65536.+tt[1]*256.+tt[2]])
+                if metatype == 0x58: # Time signature
+                    d=struct.unpack('>BBBB',data)
+                    tempoevents.append([tick,metatype,d])
+                if metatype == 0x1:
+                    data=_text(data)
+                    if data == '@KMIDI KARAOKE FILE':
+                        self.karfile=True
+                        self.kartrack=itrack+1
+                    if self.karfile and itrack == self.kartrack:
+                        if data[:1] != '@':
+                            if '\\' in data:
+                                self.karsyl.append('\\')
+                                self.kartimes.append(tick)
+                                data=data.replace('\\','')
+                            if '/' in data:
+                                self.karsyl.append('/')
+                                self.kartimes.append(tick)
+                                data=data.replace('/','')
+                            self.karsyl.append(data)
+                            self.kartimes.append(tick)    
+                if metatype == 0x3: # Track name
+                    self._tracknames[itrack]=_text(data)
+
+            elif status == 0xF0 or status == 0xF7: # Now a Sysex event
+                pass
+
+            else: # MIDI messages
+                status1 = status >> 4
+                status2 = status & 0xF
+                if status1 == 0b1100: # Program change
+                    currentpatch=data1
+                    patches.append([itrack,currentpatch,tick])
+                elif status1 == 0b1001 and data2 > 0: # Note on event
+                    note=[data1,data2,status2,currentpatch,itrack,tick,-1]
+                    key=(status2,data1)
+                    if key in active: # If it was previously on, count it off
+                        active[key][6]=tick
+                        retriggered=retriggered+1
+                    active[key]=note
+                    notes.append(note)
+                elif status1 == 0b1000 or status1 == 0b1001: # Note off event
+                    note=active.pop((status2,data1),None)
+                    if note != None:
+                        note[6]=tick
+            # End MIDI event
+        for note in active.values(): # Still sounding at the end of track
+            note[6]=tick
+        self._endtick=max(self._endtick,tick)
+        if events != None:
+            self._original[itrack]=list(events)
+        if self.stats != None:
+            stats=self.stats
+            stats.tracktimes[itrack]=time.time()-t0
+            stats.bytesread['tracks']+=end-pos
+            nnotes=len(notes)-n0notes
+            stats.notes['total']+=nnotes
+            stats.notes['retriggered']+=retriggered
+            stats.notes['endoftrack']+=len(active)
+            stats.notes['noteoff']+=nnotes-retriggered-len(active)
+            stats.phase('tracks',stats.tracktimes[itrack])
+        return
+
+
+    def _set_tempo(self,tempoevents):
+        # Builds the tempo map from the tempo events of all tracks and
+        # converts the times of the parsed events from ticks to seconds
+        tempoevents.sort(key=lambda e: e[0])
+        self.tempomap=tempomap(self.division,[[e[0],e[2]] for e in tempoevents if e[1] == 0x51])
+        tick2sec=self.tempomap.tick2sec
+        for e in tempoevents:
+            mastertime=tick2sec(e[0])
+            if e[1] == 0x51: # Set tempo
+                self.microsecondsperquarternote.append([e[2],mastertime])
+                self.bpm.append([60000000. / self.microsecondsperquarternote[-1][0] * (self.den[-1][0] / self.num[-1][0]), mastertime])
+                self.num.append([self.num[-1][0], mastertime])
+                self.den.append([self.den[-1][0], mastertime])
+            else: # Time signature
+                d=e[2]
+                self.num.append([float(d[0]),mastertime])
+                self.den.append([float(2**d[1]),mastertime])
+                self.microsecondsperquarternote.append([self.microsecondsperquarternote[-1][0], mastertime])
+                self.bpm.append([self.bpm[-1][0], mastertime])
+        self.kartimes=[tick2sec(tick) for tick in self.kartimes]
+        return
+
+
+    def _ticks2seconds(self,n0notes,n0patches):
+        # Converts the times of the notes and patches parsed since the
+        # given list positions from ticks to seconds
+        self._convert_times(self._notes[n0notes:],self._patchesused[n0patches:])
+        self.duration=self.tempomap.tick2sec(self._endtick)
+        return
+
+
+    def _convert_times(self,notes,patches):
+        tick2sec=self.tempomap.tick2sec
+        for patch in patches:
+            patch[2]=tick2sec(patch[2])
+        for note in notes:
+            note[5]=tick2sec(note[5])
+            if note[6] >= 0:
+                note[6]=tick2sec(note[6])
+        return
+
+
+    def iter_events(self,fileobject):
+        # Generator with the events of all tracks merged in time order.
+        # Only one decoded event per track is kept pending at any time
+        [buf,source]=self._open_buffer(fileobject)
         if self.closeonreturn:
             self.fileobject.close()
-        return self.error
+        generators=list()
+        heap=list()
+        event=None
+        data=None
+        try:
+            _check_header(buf)
+            [headerlen,fileformat,ntracks,division]=struct.unpack_from('>IHHh',buf,4)
+            if division < 0: # It's a different format SMTPE
+                self.error=1
+                return
+            pos=8+headerlen
+            while len(generators) < ntracks and pos+8 <= len(buf):
+                trackid=bytes(buf[pos:pos+4])
+                tracklen=struct.unpack_from('>I',buf,pos+4)[0]
+                pos=pos+8
+                end=min(pos+tracklen,len(buf))
+                if trackid == b'MTrk':
+                    generators.append(_track_events(buf,pos,end))
+                    self._push_event(heap,generators,len(generators)-1,0)
+                pos=end
+
+            kartrack=-1
+            # Real time is updated at each tempo change, which are met in
+            # tick order
+            tick0=0
+            time0=0.
+            secondspertick=60./120/division # Midi default
+            while len(heap) > 0:
+                [tick,itrack,event]=heapq.heappop(heap)
+                self._push_event(heap,generators,itrack,tick)
+                [dtime,status,data1,data2,data]=event
+                mastertime=time0+(tick-tick0)*secondspertick
+                if status == 0xFF: # META event
+                    data=bytes(data)
+                    kind='meta'
+                    if data1 == 0x51: # Set tempo
+                        kind='tempo'
+                        tt=struct.unpack('>BBB',data)
+                        data2=tt[0]*65536.+tt[1]*256.+tt[2]
+                        tick0=tick
+                        time0=mastertime
+                        secondspertick=data2*1e-6/division
+                    elif data1 == 0x58: # Time signature
+                        kind='time_signature'
+                    elif data1 == 0x2F: # End of track
+                        kind='end_of_track'
+                    elif data1 == 0x1 or data1 == 0x5: # Text or lyric
+                        kind='text'
+                        data=_text(data)
+                        if data == '@KMIDI KARAOKE FILE':
+                            kartrack=itrack+1
+                        if data1 == 0x5 or (itrack == kartrack and data[:1] != '@'):
+                            kind='lyric'
+                    yield midievent(kind,tick,mastertime,itrack,None,data1,data2,data)
+                elif status == 0xF0 or status == 0xF7: # Sysex event
+                    yield midievent('sysex',tick,mastertime,itrack,None,None,None,bytes(data))
+                else: # MIDI messages
+                    status1 = status >> 4
+                    kind=_eventkinds[status1]
+                    if status1 == 0b1001 and data2 == 0:
+                        kind='note_off'
+                    yield midievent(kind,tick,mastertime,itrack,status & 0xF,data1,data2,None)
+        finally:
+            for generator in generators:
+                generator.close()
+            # The pending events hold slices of buf (maybe memory-mapped)
+            del heap[:]
+            event=None
+            data=None
+            self._close_buffer(buf,source)
+        return
 
 
-    def update_karaoke(self, dt):
-        if not self.karfile or self.kartrack == 0 or len(self.karsyl) == 0:
+    def _push_event(self,heap,generators,itrack,tick):
+        # Adds the next event of a track to the heap, if any
+        for event in generators[itrack]:
+            heapq.heappush(heap,[tick+event[0],itrack,event])
             return
-        if self.karidx >= len(self.karsyl)-1:
-            return
-        dt0=self.kartimes[self.karidx]
-        while dt > dt0 and self.karidx < len(self.kartimes)-1:
-            self.karidx=self.karidx+1
-            dt0=self.kartimes[self.karidx]
-        self.karidx=max(self.karidx-1,0)
-        if self.karidx == self.karievent1[2]: # If reached the end of 3 lines,
-            self.karidx=self.karidx+1 # Make sure next 3 lines are displayed
-        self.karidx=min(self.karidx,len(self.kartimes)-1)
-        if self.karidx > self.karievent1[2]: # Clear and load next three lines
-            self.karlinea=['']*3
-            self.karlineb=['']*3
-            self.karievent0=[len(self.karsyl)-1]*3
-            self.karievent1=[len(self.karsyl)-1]*3
-            self.karievent0[0]=self.karidx            
-            idx=self.karidx+1
-            iline=0
-            while idx <= len(self.karsyl)-1:
-                if self.karsyl[idx]== '/': # Next line
-                    self.karievent1[iline]=idx-1
-                    iline=iline+1
-                    if iline == 3:
-                        break
-                    self.karievent0[iline]=idx+1
-                if self.karsyl[idx] == '\\': # End of three lines
-                    self.karievent1[iline]=idx-1
-                    if iline < 2:
-                        for i in range(iline+1,3):
-                            self.karievent0[i]=idx-1
-                            self.karievent1[i]=idx-1
-                    break
-                idx=idx+1
-
-        for iline in range(3): # Colored text
-            if self.karievent0[iline] == self.karievent1[iline]:
-                self.karlinea[iline]=''
-                continue
-            i0=self.karievent0[iline]
-            i1=self.karidx
-            if i1 < self.karievent0[iline]:
-                self.karlinea[iline]=''
-                continue
-            if i1 > self.karievent1[iline]:
-                i1=self.karievent1[iline]
-            self.karlinea[iline]=''.join(self.karsyl[i0:i1+1])
-            self.karlinea[iline]=re.sub('\\\\','',self.karlinea[iline])
-            self.karlinea[iline]=re.sub('/','',self.karlinea[iline])
-        for iline in range(3): # White text
-            if self.karievent0[iline] == self.karievent1[iline]:
-                self.karlineb[iline]=''
-                continue
-            i0=self.karidx+1
-            if i0 < self.karievent0[iline]:
-                i0=self.karievent0[iline]
-            i1=self.karievent1[iline]
-            if i0 > i1:
-                self.karlineb[iline]=''
-                continue
-            if self.karievent1[iline] < i0:
-                i0=self.karidx
-            self.karlineb[iline]=''.join(self.karsyl[i0:i1+1])
-            self.karlineb[iline]=re.sub('\\\\','',self.karlineb[iline])
-            self.karlineb[iline]=re.sub('/','',self.karlineb[iline])
+        return
 
-        # Special case for song end
-        if dt >= max(self.kartimes):
-            for iline in range(-2,1):
-                if self.karlinea[iline] != '':
-                    self.karlinea[iline]=''.join(self.karsyl[self.karievent0[iline]:])
-                    self.karlinea[iline]=re.sub('\\\\','',self.karlinea[iline])
-                    self.karlinea[iline]=re.sub('/','',self.karlinea[iline])
-                    self.karlineb[iline]=''
-                    break
 
-        return False
+    def get_notetable(self):
+        import notetable # Requires numpy
+        if self._loader != None and self._notecolumns != None: # From songcache
+            return notetable.notetable(columns=self._notecolumns)
+        if isinstance(self.notes,recordlist):
+            return notetable.notetable(columns=self.notes.columns)
+        return notetable.notetable(self.notes)
+
+
+    def compact(self):
+        # Replaces the lists of lists by recordlists
+        self.wait_loaded()
+        self._notes=recordlist(noterecord,_notetypes,self._notes)
+        self._patchesused=recordlist(patchrecord,_patchtypes,self._patchesused)
+        for name in ['bpm','microsecondsperquarternote','num','den']:
+            setattr(self,name,recordlist(temporecord,_tempotypes,getattr(self,name)))
+        return self
+
+
+    def _index_lyrics(self):
+        # Precomputes what update_karaoke needs for each frame: the text
+        # of all the syllables with the line and page marks removed, the
+        # offset of each syllable in it and the position of the marks
+        text=list()
+        self._karoffsets=[0]
+        self._karseps=list()
+        for idx in range(len(self.karsyl)):
+            syl=self.karsyl[idx]
+            if syl == '/' or syl == '\\':
+                self._karseps.append(idx)
+            syl=syl.replace('\\','').replace('/','')
+            text.append(syl)
+            self._karoffsets.append(self._karoffsets[-1]+len(syl))
+        self._kartext=''.join(text)
+        self._karend=max(self.kartimes) if len(self.kartimes) > 0 else 0.
+        self._karstate=None
+        self._kardt=0.
+        # Pages in the order update_karaoke shows them when the song is
+        # played from the start. Used to seek to any point
+        self._karpagestarts=list()
+        self._karpages=list()
+        last=len(self.karsyl)-1
+        start=0
+        while last >= 0:
+            page=self._karaoke_page(start)
+            self._karpagestarts.append(start)
+            self._karpages.append(page)
+            end=page[1][2]
+            if end >= last:
+                break
+            # Next page shows up when the last syllable of this one (and any
+            # other at the same time) is reached
+            start=min(max(end+1,bisect.bisect_right(self.kartimes,self.kartimes[end])-1),last)
+            if start <= self._karpagestarts[-1]:
+                break
+        return
 
 
-    def write_file(self,filein,fileout,tracks2remove,patches2remove):
+    def karaoke_text(self):
+        return _karaoke_text(self.karsyl)
+
+
+    def _karaoke_page(self,start):
+        # First and last syllable of the (up to) three lines that are
+        # displayed when the page starts at syllable start
+        last=len(self.karsyl)-1
+        karievent0=[last]*3
+        karievent1=[last]*3
+        karievent0[0]=start
+        iline=0
+        for isep in range(bisect.bisect_right(self._karseps,start),len(self._karseps)):
+            idx=self._karseps[isep]
+            if self.karsyl[idx] == '/': # Next line
+                karievent1[iline]=idx-1
+                iline=iline+1
+                if iline == 3:
+                    break
+                karievent0[iline]=idx+1
+            else: # End of three lines
+                karievent1[iline]=idx-1
+                for i in range(iline+1,3):
+                    karievent0[i]=idx-1
+                    karievent1[i]=idx-1
+                break
+        return [karievent0,karievent1]
+
+
+    def write_file(self,filein,fileout,tracks2remove,patches2remove,
+                   transpose=0,tempo=1.,t0=None,t1=None):
         if tracks2remove == None:
             tracks2remove=list()
         if patches2remove == None:
             patches2remove=list()
         
-        fout=open(fileout,'wb')
-        if type(filein) == str:
-            self.fileobject=open(filein,'rb')
-            self.closeonreturn=True
+        [buf,source]=self._open_buffer(filein)
+        if self.closeonreturn:
+            self.fileobject.close()
+        try:
+            _check_header(buf)
+            [headerlen,fileformat,ntracks,division]=struct.unpack_from('>IHHh',buf,4)
+            if division < 0: # It's a different format SMTPE
+                self.error=1
+                return self.error
+
+            tick0=0
+            tick1=None
+            if t0 != None or t1 != None:
+                [tick0,tick1]=_cut_ticks(self._scan_tempomap(buf,headerlen,ntracks,division),t0,t1)
+            filters=transpose != 0 or tempo != 1 or tick0 > 0 or tick1 != None
+
+            # Tracks are copied as they are unless some event changes. The
+            # chunks to copy are kept as [pos,end], not as slices of buf, so
+            # that nothing refers to buf (maybe memory-mapped) when closed
+            chunks=list()
+            ntracks2=0
+            itrack=0
+            pos=8+headerlen
+            while pos+8 <= len(buf):
+                trackid=bytes(buf[pos:pos+4])
+                tracklen=struct.unpack_from('>I',buf,pos+4)[0]
+                end=min(pos+8+tracklen,len(buf))
+                if trackid != b'MTrk' or itrack >= ntracks: # Not a track
+                    chunks.append([pos,end])
+                elif itrack in tracks2remove:
+                    itrack=itrack+1
+                else:
+                    data=None
+                    if filters:
+                        [events,changed]=_variant_events(_absolute_events(buf,pos+8,end),patches2remove,
+                                                         [],tick0,tick1,transpose,tempo)
+                        if tempo != 1 and ntracks2 == 0: # The first track sets the tempo
+                            _set_default_tempo(events,tempo)
+                            changed=True
+                        if changed:
+                            data=_encode_events(events)
+                        events=None # Holds slices of buf
+                    elif len(patches2remove) > 0:
+                        data=_filter_track(buf,pos+8,end,patches2remove)
+                    if data == None:
+                        chunks.append([pos,end])
+                    else:
+                        chunks.append(b'MTrk'+struct.pack('>I',len(data))+data)
+                    ntracks2=ntracks2+1
+                    itrack=itrack+1
+                pos=end
+
+            fout=open(fileout,'wb')
+            fout.write(buf[0:10])
+            fout.write(struct.pack('>H',ntracks2))
+            fout.write(buf[12:8+headerlen])
+            for chunk in chunks:
+                if isinstance(chunk,list):
+                    fout.write(buf[chunk[0]:chunk[1]])
+                else:
+                    fout.write(chunk)
+            fout.close()
+        finally:
+            self._close_buffer(buf,source)
+        return self.error
+
+
+    def _scan_tempomap(self,buf,headerlen,ntracks,division):
+        # Tempo map of the file in buf, for the time range of write_file.
+        # Only the tracks with a tempo event are walked
+        tempos=list()
+        itrack=0
+        pos=8+headerlen
+        while pos+8 <= len(buf) and itrack < ntracks:
+            trackid=bytes(buf[pos:pos+4])
+            tracklen=struct.unpack_from('>I',buf,pos+4)[0]
+            end=min(pos+8+tracklen,len(buf))
+            if trackid == b'MTrk':
+                if _find(buf,b'\xFF\x51\x03',pos+8,end) >= 0:
+                    for [tick,status,data1,data2,data] in _absolute_events(buf,pos+8,end):
+                        if status == 0xFF and data1 == 0x51 and len(data) == 3:
+                            tt=struct.unpack('>BBB',data)
+                            tempos.append([tick,tt[0]*65536.+tt[1]*256.+tt[2]])
+                itrack=itrack+1
+            pos=end
+        return tempomap(division,tempos)
+
+
+    def write_variant(self,fileout,tracks2remove=None,patches2remove=None,
+                      channels2remove=None,t0=None,t1=None,transpose=0,tempo=1.):
+        if self.error:
+            return self.error
+        self.wait_loaded() # Tracks left by lyricsonly or background
+        if self.events == None:
+            raise ValueError('write_variant needs load_file(..., keepevents=True)')
+        if tracks2remove == None:
+            tracks2remove=list()
+        if patches2remove == None:
+            patches2remove=list()
+        if channels2remove == None:
+            channels2remove=list()
+        [tick0,tick1]=_cut_ticks(self.tempomap,t0,t1)
+        filters=(len(patches2remove) > 0 or len(channels2remove) > 0 or transpose != 0 or
+                 tempo != 1 or tick0 > 0 or tick1 != None)
+
+        chunks=list()
+        ntracks2=0
+        for chunk in self._chunks[1:]:
+            if not isinstance(chunk,int): # Not a track
+                chunks.append(chunk)
+                continue
+            itrack=chunk
+            if itrack in tracks2remove:
+                continue
+            changed=self.events[itrack] != self._original[itrack] # Edited
+            if changed or filters:
+                [events,filtered]=_variant_events(self.events[itrack],patches2remove,
+                                                  channels2remove,tick0,tick1,transpose,tempo)
+                changed=changed or filtered
+            if tempo != 1 and ntracks2 == 0: # The first track sets the tempo
+                _set_default_tempo(events,tempo)
+                changed=True
+            if not changed:
+                chunks.append(self._rawtracks[itrack])
+            else:
+                data=_encode_events(events)
+                chunks.append(b'MTrk'+struct.pack('>I',len(data))+data)
+            ntracks2=ntracks2+1
+
+        header=self._chunks[0]
+        if type(fileout) == str:
+            fout=open(fileout,'wb')
         else:
-            self.fileobject=filein
-
-        headerid=self.fileobject.read(4)
-        fout.write(headerid)
-        headerlen=self.fileobject.read(4)
-        fout.write(headerlen)
-        fileformat=self.fileobject.read(2)
-        fout.write(fileformat)
-        ntracks=self.fileobject.read(2)
-        ntracks=struct.unpack('>H',ntracks)[0]
-        ntracks2=ntracks-len(tracks2remove)
+            fout=fileout
+        fout.write(header[0:10])
         fout.write(struct.pack('>H',ntracks2))
-        tracknames=['']*ntracks
-        division=self.fileobject.read(2)
-        fout.write(division)
-        division=struct.unpack('>h',division)[0]
-        if division < 0: # It's a different format SMTPE
-            error=1
+        fout.write(header[12:])
+        for chunk in chunks:
+            fout.write(chunk)
+        if type(fileout) == str:
             fout.close()
-            if closeonreturn:
-                self.fileobject.close()
-            return error
+        return self.error
 
-        for itrack in range(ntracks):
-            writetrack=True
-            if itrack in tracks2remove:
-                writetrack=False
-            currentpatch=0
-            mastertime=0
-            trackid=self.fileobject.read(4)
-            if writetrack:
-                fout.write(trackid)
-            read=self.fileobject.read(4)
-            if writetrack:
-                fout.write(read)
-            tracklen=struct.unpack('>I',read)[0]
-            # track event
-            metatype=0
-            iread=0
-            while iread < tracklen and metatype != 0x2f:
-                [dtime,nbytesread,bytesread]=self.read_var_length()
-                if writetrack:
-                    fout.write(bytesread)
-                iread=iread+nbytesread
-                # Midi event
-                read=self.fileobject.read(1)
-                if writetrack:
-                    fout.write(read)
-                status=struct.unpack('>B',read)[0]
-                iread=iread+1
-
-                # Set timing conversion. Find tempo for previous event at mastertime
-                i0=len(self.microsecondsperquarternote)-1
-                while (self.microsecondsperquarternote[i0][1]) > mastertime:
-                    i0=i0-1
-                # Try with that tempo
-                tickspermicrosecond=division/self.microsecondsperquarternote[i0][0]
-                secondspertick=1./tickspermicrosecond*1e-6
-                dtimesec=dtime*secondspertick
-                # Check if there has been a tempo change in that interval
-                i1=len(self.microsecondsperquarternote)-1
-                while (self.microsecondsperquarternote[i1][1]) > mastertime+dtimesec:
-                    i1=i1-1
-                if i1 != i0: # Tempo has changed. Recompute using MIDI steps
-                    tickspermicrosecond=division/self.microsecondsperquarternote[i0][0]
-                    secondspertick0=1./tickspermicrosecond*1e-6
-                    tickspermicrosecond=division/self.microsecondsperquarternote[i1][0]
-                    secondspertick1=1./tickspermicrosecond*1e-6
-                    dtimesec=0.
-                    for itick in range(dtime):
-                        if mastertime+dtimesec <  self.microsecondsperquarternote[i1][1]:
-                            dtimesec=dtimesec+secondspertick0
-                        else:
-                            dtimesec=dtimesec+secondspertick1
-
-
-                else: # No tempo change. Proceed with value at i0            
-                    tickspermicrosecond=division/self.microsecondsperquarternote[i0][0]
-                    secondspertick=1./tickspermicrosecond*1e-6
-                    dtimesec=dtime*secondspertick
-
-                mastertime=mastertime+dtimesec
-
-                if status == 0xFF: # It's a non-MIDI event, META event
-                    read=self.fileobject.read(1)
-                    metatype=struct.unpack('>B',read)[0]
-                    if writetrack:
-                        fout.write(read)
-                    iread=iread+1
-                    [l,nb,bytesread]=self.read_var_length()
-                    if writetrack:
-                        fout.write(bytesread)
-                    iread=iread+nb
-                    data=self.fileobject.read(l)
-                    if writetrack:
-                        fout.write(data)
-                    iread=iread+l
-                    if metatype == 0x51: # Set tempo
-                        tt=struct.unpack('>BBB',data)
-                    if metatype == 0x58: # Time signature
-                        d=struct.unpack('>BBBB',data)
-
-                elif status == 0xF0 or status == 0xF7: # Now a Sysex event
-                    [l,nb,bytesread]=self.read_var_length()
-                    if writetrack:
-                        fout.write(bytesread)
-                    iread=iread+nb
-                    data=self.fileobject.read(l)
-                    if writetrack:
-                        fout.write(data)
-                    iread=iread+l
 
-                else: # MIDI messages
-                    if status < 128: # Use running status instead
-                        status=runningstatus
-                        self.fileobject.seek(-1,1)
-                        if writetrack:
-                            fout.seek(-1,1)
-                        iread=iread-1
-                    status1 = status / 16
-                    status2 = status % 16
-                    channel=status2
-
-                    writeevent=True
-                    if currentpatch in patches2remove:
-                        writeevent=False
-
-                    if status1 == 0b1100: # Program change
-                        read=self.fileobject.read(1)
-                        if writetrack:
-                            fout.write(read)
-                        read=struct.unpack('>B',read)[0]
-                        currentpatch=read
-                        iread=iread+1
-                    elif status1 == 0b1101: # After-touch
-                        read=self.fileobject.read(1)
-                        if writetrack:
-                            fout.write(read)
-                        read=struct.unpack('>B',read)[0]
-                        iread=iread+1
-                    else:
-                        read1=self.fileobject.read(1)
-                        read2=self.fileobject.read(1)
-                        if writetrack:
-                            if not writeevent:
-                                read2=struct.pack('>B',0)
-                            fout.write(read1)
-                            fout.write(read2)
-                        data1=struct.unpack('>B',read1)[0]
-                        data2=struct.unpack('>B',read2)[0]
-                        iread=iread+2
-
-                    runningstatus=status
-                # End MIDI event
-
-
-        fout.close()
-        if self.closeonreturn:
-            self.fileobject.close()
-        return self.error
+class song(object):
+
+    """
+Read-only copy of the parsed data of a midifile object, to be shared by
+many playbacks (see playbackcursor) or threads. Lists are replaced by
+tuples (notes, patchesused and the tempo lists by read-only recordlists)
+and attributes can't be set, so nothing can change it once built.
+
+   song(m): Song with the data of midifile object m, on which load_file()
+     has been run. Tracks left by lyricsonly or background are decoded
+     (or waited for) first.
+
+ATTRIBUTES:
+
+     Same as midifile for the parsed data: error, division, tempomap,
+   bpm, microsecondsperquarternote, num, den, karfile, kartrack, karsyl,
+   kartimes, ntracks, tracknames, duration, trackindex, patchesused and
+   notes
+
+METHODS:
+
+   cursor(): Returns a new playbackcursor for this song
+
+   karaoke_text(), get_notetable(): As in midifile
+"""
+
+    def __init__(self,m):
+        m.wait_loaded()
+        def freeze(values): # Tuples of tuples
+            return tuple([tuple(value) for value in values])
+        data=dict()
+        for name in ['error','division','karfile','kartrack','ntracks','duration','_karend']:
+            data[name]=getattr(m,name)
+        for name in ['karsyl','kartimes','tracknames','_karoffsets','_karseps','_karpagestarts']:
+            data[name]=tuple(getattr(m,name))
+        data['trackindex']=freeze(m.trackindex)
+        data['notes']=recordlist(noterecord,_notetypes,m.notes,True)
+        data['patchesused']=recordlist(patchrecord,_patchtypes,m.patchesused,True)
+        for name in ['bpm','microsecondsperquarternote','num','den']:
+            data[name]=recordlist(temporecord,_tempotypes,getattr(m,name),True)
+        data['_kartext']=m._kartext
+        data['_karpages']=tuple([freeze(page) for page in m._karpages])
+        data['tempomap']=None
+        if m.tempomap != None:
+            data['tempomap']=tempomap(m.division)
+            for name in ['ticks','seconds','secondspertick']:
+                setattr(data['tempomap'],name,tuple(getattr(m.tempomap,name)))
+        self.__dict__.update(data)
+        return
+
+    def __setattr__(self,name,value):
+        raise AttributeError('song objects are read-only')
+
+    def cursor(self):
+        return playbackcursor(self)
+
+    def karaoke_text(self):
+        return _karaoke_text(self.karsyl)
+
+    def get_notetable(self):
+        import notetable # Requires numpy
+        return notetable.notetable(columns=self.notes.columns)
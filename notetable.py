@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#
+# (c) 2015 Hector Socas-Navarro (hsocas.iac@gmail.com)
+#
+
+import numpy
+
+class notetable:
+
+    """
+This module defines the class notetable, a columnar version of the notes
+attribute of the midifile class. Instead of a list with one 7-element list
+per note, the notes are stored in parallel numpy arrays (one per field),
+which take a fraction of the memory and can be filtered without Python
+loops. Requires: numpy.
+
+ATTRIBUTES:
+
+     pitch, velocity, channel, patch: uint8 arrays with the note number,
+   velocity, MIDI channel and patch (instrument) of each note
+
+     track: uint16 array with the track number of each note
+
+     ton, toff: float64 arrays with the real time (in seconds) of the
+   note on and note off events of each note
+
+METHODS:
+
+   notetable(notes, columns=None): Builds the table from a list like
+     midifile.notes, or from a list with one sequence (or array) per
+     field if columns is given. Use midifile.get_notetable() to get the
+     table of a parsed file.
+
+   active_at(t): notetable with the notes sounding at time t
+
+   in_window(t0, t1): notetable with the notes sounding at some point
+     between t0 and t1
+
+   pitch_range(): Three arrays with the tracks that have notes and the
+     lowest and highest pitch used in each of them
+
+   patch_counts(): Array with the number of notes played by each of
+     the 128 patches
+
+   take(idx): notetable with the notes selected by idx (an index array
+     or a boolean mask)
+
+   to_list(): Returns the notes as a list like midifile.notes
+"""
+
+    fields=[['pitch',numpy.uint8],['velocity',numpy.uint8],['channel',numpy.uint8],
+            ['patch',numpy.uint8],['track',numpy.uint16],['ton',numpy.float64],
+            ['toff',numpy.float64]]
+
+    def __init__(self,notes=None,columns=None):
+        if columns == None:
+            if notes == None:
+                notes=list()
+            columns=list(zip(*notes))
+        if len(columns) == 0:
+            columns=[()]*len(self.fields)
+        for [[name,dtype],column] in zip(self.fields,columns):
+            setattr(self,name,numpy.asarray(column,dtype=dtype))
+        return
+
+    def __len__(self):
+        return len(self.pitch)
+
+    def take(self,idx):
+        table=notetable()
+        for [name,dtype] in self.fields:
+            setattr(table,name,getattr(self,name)[idx])
+        return table
+
+    def active_at(self,t):
+        return self.take((self.ton <= t) & (self.toff > t))
+
+    def in_window(self,t0,t1):
+        return self.take((self.ton < t1) & (self.toff > t0))
+
+    def pitch_range(self):
+        if len(self) == 0:
+            empty=numpy.array([],dtype=numpy.uint8)
+            return [numpy.array([],dtype=numpy.uint16),empty,empty]
+        order=numpy.argsort(self.track,kind='stable')
+        tracks,starts=numpy.unique(self.track[order],return_index=True)
+        pitch=self.pitch[order]
+        return [tracks,numpy.minimum.reduceat(pitch,starts),numpy.maximum.reduceat(pitch,starts)]
+
+    def patch_counts(self):
+        return numpy.bincount(self.patch,minlength=128)
+
+    def to_list(self):
+        return [list(note) for note in zip(self.pitch.tolist(),self.velocity.tolist(),
+                self.channel.tolist(),self.patch.tolist(),self.track.tolist(),
+                self.ton.tolist(),self.toff.tolist())]
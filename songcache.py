@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+#
+# (c) 2015 Hector Socas-Navarro (hsocas.iac@gmail.com)
+#
+
+"""
+This module keeps the result of midifile.load_file on disk, so that a song
+that has already been parsed is loaded with a few reads instead of being
+parsed again. Each entry is stored in a compact binary format: a short
+header followed by named sections, each one a flat array of numbers (the
+note and patch fields, times, tempo lists...) or of text bytes. Reading an
+entry creates one array per section and no Python object per event. The
+notes and patchesused lists are only built if they are used (see
+midifile.get_notetable for a way to use the arrays directly).
+
+   songcache(directory, maxsize=256*1024*1024, key='content'): Cache
+     stored in directory (created if needed). When the entries take more
+     than maxsize bytes, the least recently used ones are removed. key
+     selects how songs are identified: 'content' uses a SHA-1 hash of the
+     file contents, 'stat' uses the path, size and modification time of
+     the file (faster but misses renamed copies).
+
+   songcache.load(filename): Returns a midifile object for filename,
+     either from the cache or by parsing it (and adding it to the cache).
+     The attributes hits and misses count each case.
+
+   dumps(m), loads(data): Convert a midifile object on which load_file()
+     has been run to the binary format and back.
+"""
+
+import struct, sys, os, io, array, hashlib, tempfile
+import midifile
+
+VERSION=2 # Change every time the format or the parsed values change
+MAGIC=b'KPYC'
+PY3=sys.version_info[0] >= 3
+NOTEFIELDS=[['pitch','B'],['velocity','B'],['channel','B'],['patch','B'],
+            ['track','H'],['ton','d'],['toff','d']]
+PATCHFIELDS=[['ptrack','H'],['ppatch','B'],['ptime','d']]
+
+
+def _tobytes(a):
+    if PY3:
+        return a.tobytes()
+    return a.tostring()
+
+
+def _array(typecode,data):
+    a=array.array(typecode)
+    if PY3:
+        a.frombytes(data)
+    else:
+        a.fromstring(data)
+    return a
+
+
+def _encode(text):
+    if PY3:
+        return text.encode('latin-1')
+    return text
+
+
+def _decode(data):
+    if PY3:
+        return data.decode('latin-1')
+    return data
+
+
+def _strings(strings):
+    # Text blob and offsets of a list of strings
+    data=[_encode(s) for s in strings]
+    offsets=array.array('i',[0])
+    for d in data:
+        offsets.append(offsets[-1]+len(d))
+    return [b''.join(data),offsets]
+
+
+def _unstrings(data,offsets):
+    return [_decode(data[offsets[i]:offsets[i+1]]) for i in range(len(offsets)-1)]
+
+
+def _pairs(values):
+    # [[value,time],...] lists as a flat array of floats
+    return array.array('d',[v for pair in values for v in pair])
+
+
+def _unpairs(a):
+    values=a.tolist()
+    return [[values[i],values[i+1]] for i in range(0,len(values),2)]
+
+
+def dumps(m):
+    sections=list()
+    sections.append(['header',array.array('i',[int(m.error),m.ntracks,m.division,
+                                              int(m.karfile),m.kartrack])])
+    sections.append(['duration',array.array('d',[m.duration])])
+    sections.append(['trackindex',array.array('i',[v for chunk in m.trackindex for v in chunk])])
+    for name in ['bpm','microsecondsperquarternote','num','den']:
+        sections.append([name,_pairs(getattr(m,name))])
+    if m.tempomap != None:
+        sections.append(['tmticks',array.array('d',m.tempomap.ticks)])
+        sections.append(['tmseconds',array.array('d',m.tempomap.seconds)])
+        sections.append(['tmsecondspertick',array.array('d',m.tempomap.secondspertick)])
+    [data,offsets]=_strings(m.tracknames)
+    sections.append(['tracknames',_array('B',data)])
+    sections.append(['tracknamesoff',offsets])
+    [data,offsets]=_strings(m.karsyl)
+    sections.append(['karsyl',_array('B',data)])
+    sections.append(['karsyloff',offsets])
+    sections.append(['kartimes',array.array('d',m.kartimes)])
+    columns=list(zip(*m.notes))
+    for i in range(len(NOTEFIELDS)):
+        [name,typecode]=NOTEFIELDS[i]
+        sections.append([name,array.array(typecode,columns[i] if len(columns) > 0 else [])])
+    columns=list(zip(*m.patchesused))
+    for i in range(len(PATCHFIELDS)):
+        [name,typecode]=PATCHFIELDS[i]
+        sections.append([name,array.array(typecode,columns[i] if len(columns) > 0 else [])])
+
+    out=[MAGIC,struct.pack('>HBH',VERSION,sys.byteorder == 'big',len(sections))]
+    for [name,a] in sections:
+        data=_tobytes(a)
+        name=name.encode('ascii')
+        out.append(struct.pack('>B',len(name))+name+a.typecode.encode('ascii')+struct.pack('>I',len(data)))
+        out.append(data)
+    return b''.join(out)
+
+
+def _read_sections(data):
+    if data[0:4] != MAGIC or len(data) < 9:
+        raise ValueError('Not a songcache entry')
+    [version,bigendian,nsections]=struct.unpack_from('>HBH',data,4)
+    if version != VERSION:
+        raise ValueError('songcache entry version %d, expected %d' % (version,VERSION))
+    swap=bool(bigendian) != (sys.byteorder == 'big')
+    sections=dict()
+    pos=9
+    for isection in range(nsections):
+        l=struct.unpack_from('>B',data,pos)[0]
+        name=data[pos+1:pos+1+l].decode('ascii')
+        pos=pos+1+l
+        typecode=data[pos:pos+1].decode('ascii')
+        nbytes=struct.unpack_from('>I',data,pos+1)[0]
+        pos=pos+5
+        if pos+nbytes > len(data):
+            raise ValueError('Truncated songcache entry')
+        a=_array(str(typecode),data[pos:pos+nbytes])
+        if swap:
+            a.byteswap()
+        sections[name]=a
+        pos=pos+nbytes
+    return sections
+
+
+def loads(data):
+    sections=_read_sections(data)
+    m=midifile.midifile()
+    [error,m.ntracks,m.division,karfile,m.kartrack]=sections['header'].tolist()
+    m.error=bool(error) and error
+    m.karfile=bool(karfile)
+    m.duration=sections['duration'][0]
+    values=sections['trackindex'].tolist()
+    m.trackindex=[values[i:i+2] for i in range(0,len(values),2)]
+    for name in ['bpm','microsecondsperquarternote','num','den']:
+        setattr(m,name,_unpairs(sections[name]))
+    if 'tmticks' in sections:
+        m.tempomap=midifile.tempomap(m.division)
+        m.tempomap.ticks=[int(tick) for tick in sections['tmticks'].tolist()]
+        m.tempomap.seconds=sections['tmseconds'].tolist()
+        m.tempomap.secondspertick=sections['tmsecondspertick'].tolist()
+    m.karsyl=_unstrings(_tobytes(sections['karsyl']),sections['karsyloff'])
+    m.kartimes=sections['kartimes'].tolist()
+    m._index_lyrics()
+    m._tracknames=_unstrings(_tobytes(sections['tracknames']),sections['tracknamesoff'])
+
+    # Notes and patches stay in the arrays until they are needed
+    m._notecolumns=[sections[name] for [name,typecode] in NOTEFIELDS]
+    patchcolumns=[sections[name] for [name,typecode] in PATCHFIELDS]
+    def loader():
+        m._notes=[list(note) for note in zip(*[c.tolist() for c in m._notecolumns])]
+        m._patchesused=[list(patch) for patch in zip(*[c.tolist() for c in patchcolumns])]
+        m._notecolumns=None
+    m._loader=loader
+    return m
+
+
+class songcache(object):
+
+    def __init__(self,directory,maxsize=256*1024*1024,key='content'):
+        self.directory=directory
+        self.maxsize=maxsize
+        self.keytype=key
+        self.hits=0
+        self.misses=0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return
+
+    def key(self,filename):
+        # Returns the key for filename and its contents, if they were read
+        if self.keytype == 'stat':
+            st=os.stat(filename)
+            text='%s:%d:%r' % (os.path.abspath(filename),st.st_size,st.st_mtime)
+            return [hashlib.sha1(text.encode('utf-8')).hexdigest(),None]
+        f=open(filename,'rb')
+        data=f.read()
+        f.close()
+        return [hashlib.sha1(data).hexdigest(),data]
+
+    def load(self,filename):
+        [key,data]=self.key(filename)
+        path=os.path.join(self.directory,key+'.kpc')
+        try:
+            f=open(path,'rb')
+            entry=f.read()
+            f.close()
+            m=loads(entry)
+            os.utime(path,None) # Most recently used
+            self.hits=self.hits+1
+            return m
+        except (IOError,OSError): # Not in cache
+            pass
+        except (ValueError,KeyError,struct.error): # Old version or damaged
+            self._remove(path)
+        self.misses=self.misses+1
+        m=midifile.midifile()
+        if data == None:
+            m.load_file(filename)
+        else:
+            m.load_file(io.BytesIO(data))
+        if not m.error:
+            self.store(path,dumps(m))
+        return m
+
+    def store(self,path,entry):
+        # Written to a temporary file first so that readers never see
+        # half an entry
+        [fd,tmppath]=tempfile.mkstemp(dir=self.directory,suffix='.tmp')
+        f=os.fdopen(fd,'wb')
+        f.write(entry)
+        f.close()
+        getattr(os,'replace',os.rename)(tmppath,path)
+        self.evict()
+        return
+
+    def evict(self):
+        entries=list()
+        for name in os.listdir(self.directory):
+            if not name.endswith('.kpc'):
+                continue
+            path=os.path.join(self.directory,name)
+            try:
+                st=os.stat(path)
+            except OSError: # Removed by someone else
+                continue
+            entries.append([st.st_mtime,st.st_size,path])
+        entries.sort()
+        total=sum([entry[1] for entry in entries])
+        for [mtime,size,path] in entries:
+            if total <= self.maxsize:
+                break
+            self._remove(path)
+            total=total-size
+        return
+
+    def _remove(self,path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
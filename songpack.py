@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#
+# (c) 2015 Hector Socas-Navarro (hsocas.iac@gmail.com)
+#
+
+"""
+This module reads songs from zip and tar archives without extracting them
+and defines the song pack, a single file with many songs and an index of
+their offsets, from which any song is parsed in place (memory-mapped)
+without copying it or opening one file per song.
+
+A song pack starts with a header (MAGIC, version and offset of the index),
+followed by the files of the songs, one after the other, and the index at
+the end (JSON, a list of [name, offset, size]).
+
+   songpack(filename): Opens a song pack and maps it in memory. Only the
+     header and the index are read. The names attribute is the list of
+     the songs, in the order they were written.
+
+     Methods:
+       load(name, m=None, **options): Returns midifile object m (a new
+         one by default) with the song loaded with load_file(...,
+         **options), e.g. lyricsonly=True. In Python 3 the song is
+         parsed in place, from a slice (memoryview) of the map
+       read(name): Bytes of the file of a song
+       close(): Closes the pack. Songs already loaded are not affected
+         (the map is kept until those with tracks still to decode are
+         decoded)
+
+   write_pack(filename, songs): Writes a song pack with songs, a sequence
+     of [name, data] with the bytes of the file of each song (it may be a
+     generator, so that only one song is in memory at a time). The pack
+     is written to a temporary file and renamed when complete.
+
+   pack_directory(directory, filename): Writes a song pack with the
+     .kar/.mid files of a directory tree, named by their path relative to
+     directory.
+
+   pack_archive(archive, filename): Writes a song pack with the .kar/.mid
+     members of a zip or tar archive, reading each one once.
+
+   archive_members(archive): Sorted list of the .kar/.mid members of a zip
+     or tar archive (filename).
+
+   load_member(archive, name, m=None, **options): Returns midifile object
+     m (a new one by default) with member name of archive loaded with
+     load_file(..., **options). The member is read into memory, not
+     extracted to disk.
+
+From the command line: python songpack.py pack.songs directory_or_archive
+"""
+
+import struct, sys, os, io, json, mmap, zipfile, tarfile, tempfile
+import midifile, catalog
+
+MAGIC=b'SONGPACK'
+VERSION=2
+HEADER='>8sIQ' # MAGIC, version, offset of the index
+
+
+def _is_song(name):
+    return os.path.splitext(name)[1].lower() in catalog.EXTENSIONS
+
+
+class songpack(object):
+
+    def __init__(self,filename):
+        self.filename=filename
+        f=open(filename,'rb')
+        try:
+            header=f.read(struct.calcsize(HEADER))
+            if len(header) < struct.calcsize(HEADER) or header[:8] != MAGIC:
+                raise ValueError('Not a song pack: %s' % filename)
+            [magic,version,indexoffset]=struct.unpack(HEADER,header)
+            if version != VERSION:
+                raise ValueError('Song pack version %d, expected %d' % (version,VERSION))
+            self.map=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        index=json.loads(self.map[indexoffset:].decode('utf-8'))
+        self.names=[name for [name,offset,size] in index]
+        self.index=dict([[name,[offset,size]] for [name,offset,size] in index])
+        self._view=None
+        if midifile.PY3:
+            self._view=memoryview(self.map)
+        return
+
+    def read(self,name):
+        [offset,size]=self.index[name]
+        return self.map[offset:offset+size]
+
+    def load(self,name,m=None,**options):
+        [offset,size]=self.index[name]
+        if m == None:
+            m=midifile.midifile()
+        if self._view == None: # Python 2 has no memoryview of an mmap
+            m.load_file(io.BytesIO(self.read(name)),**options)
+            return m
+        song=self._view[offset:offset+size]
+        try:
+            m.load_file(song,**options)
+        finally: # m keeps its own view while it has tracks to decode
+            song.release()
+        return m
+
+    def close(self):
+        if self._view != None:
+            self._view.release()
+            self._view=None
+        try:
+            self.map.close()
+        except BufferError: # Used by songs with tracks still to decode.
+            pass            # Unmapped when they are done with it
+        self.map=None
+        return
+
+
+def write_pack(filename,songs):
+    directory=os.path.dirname(os.path.abspath(filename))
+    [fd,tmppath]=tempfile.mkstemp(dir=directory,suffix='.tmp')
+    try:
+        f=os.fdopen(fd,'wb')
+        try:
+            f.write(struct.pack(HEADER,MAGIC,VERSION,0))
+            index=list()
+            for [name,data] in songs:
+                index.append([name,f.tell(),len(data)])
+                f.write(data)
+            indexoffset=f.tell()
+            f.write(json.dumps(index).encode('utf-8'))
+            f.seek(0)
+            f.write(struct.pack(HEADER,MAGIC,VERSION,indexoffset))
+        finally:
+            f.close()
+        getattr(os,'replace',os.rename)(tmppath,filename)
+    except:
+        os.remove(tmppath)
+        raise
+    return
+
+
+def _directory_songs(directory):
+    # [name, data] of each song of a directory tree, one at a time
+    for path in catalog.find_songs(directory):
+        f=open(path,'rb')
+        data=f.read()
+        f.close()
+        yield [os.path.relpath(path,directory).replace(os.sep,'/'),data]
+
+
+def pack_directory(directory,filename):
+    write_pack(filename,_directory_songs(directory))
+    return
+
+
+def _open_archive(archive):
+    if zipfile.is_zipfile(archive):
+        return zipfile.ZipFile(archive)
+    return tarfile.open(archive) # Raises tarfile.ReadError if not a tar
+
+
+def archive_members(archive):
+    a=_open_archive(archive)
+    try:
+        if isinstance(a,zipfile.ZipFile):
+            names=[name for name in a.namelist() if _is_song(name)]
+        else:
+            names=[member.name for member in a.getmembers() if member.isfile() and _is_song(member.name)]
+    finally:
+        a.close()
+    return sorted(names)
+
+
+def _archive_songs(archive):
+    # [name, data] of each song of an archive, one at a time and in the
+    # order they are stored (a compressed tar is read only once)
+    a=_open_archive(archive)
+    try:
+        if isinstance(a,zipfile.ZipFile):
+            for name in a.namelist():
+                if _is_song(name):
+                    yield [name,a.read(name)]
+        else:
+            for member in a:
+                if member.isfile() and _is_song(member.name):
+                    f=a.extractfile(member)
+                    yield [member.name,f.read()]
+                    f.close()
+    finally:
+        a.close()
+
+
+def pack_archive(archive,filename):
+    write_pack(filename,_archive_songs(archive))
+    return
+
+
+def load_member(archive,name,m=None,**options):
+    if m == None:
+        m=midifile.midifile()
+    a=_open_archive(archive)
+    try:
+        if isinstance(a,zipfile.ZipFile):
+            f=a.open(name)
+        else:
+            f=a.extractfile(name)
+        try:
+            m.load_file(f,**options)
+        finally:
+            f.close()
+    finally:
+        a.close()
+    return m
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: python songpack.py pack.songs directory_or_archive')
+        sys.exit(1)
+    if os.path.isdir(sys.argv[2]):
+        pack_directory(sys.argv[2],sys.argv[1])
+    else:
+        pack_archive(sys.argv[2],sys.argv[1])
+    pack=songpack(sys.argv[1])
+    print('%d songs in %s' % (len(pack.names),sys.argv[1]))
+    pack.close()
@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+#
+# (c) 2015 Hector Socas-Navarro (hsocas.iac@gmail.com)
+#
+
+"""
+Regression checks for midifile. Songs are made by hand (with known times)
+or with benchmark.synthetic_song, so nothing but the standard library is
+needed. Run them with:
+
+   python -m unittest test_midifile
+"""
+
+import os, io, mmap, struct, shutil, tempfile, unittest
+import midifile, benchmark, fingerprint, catalog, songpack, lyricindex
+
+
+def _song(tracks,division=96):
+    # Format 1 file with one MTrk chunk per list of [tick, bytes] events
+    chunks=[benchmark._chunk(list(events)) for events in tracks]
+    return b'MThd'+struct.pack('>IHHh',6,1,len(chunks),division)+b''.join(chunks)
+
+
+def _tempo(mpq):
+    return benchmark._meta(0x51,[mpq >> 16,(mpq >> 8) & 0xFF,mpq & 0xFF])
+
+
+def _text(text):
+    return benchmark._meta(0x1,text)
+
+
+# 96 ticks per quarter note at 120 bpm (1/192 s per tick) until tick 192,
+# where the instrument track (not the conductor) sets 240 bpm
+TEMPOSONG=_song([[[0,_tempo(500000)]],
+                 [[0,_text(b'@KMIDI KARAOKE FILE')]],
+                 [[0,_text(b'\\La')],[96,_text(b'la ')],[384,_text(b'lo')]],
+                 [[0,bytearray([0xC0,5])],[0,bytearray([0x90,60,100])],[192,_tempo(250000)],
+                  [288,bytearray([0x80,60,0])],[384,bytearray([0x90,62,90])],
+                  [480,bytearray([0x90,62,80])],[576,bytearray([0x91,64,70])]]])
+TEMPOTIMES=[0.,0.,0.5,1.5]
+# pitch, velocity, channel, patch, track, time on, time off
+TEMPONOTES=[[60,100,0,5,3,0.,1.25],[62,90,0,5,3,1.5,1.75],[62,80,0,5,3,1.75,2.],[64,70,1,5,3,2.,2.]]
+
+# Note off, note on with velocity 0, a retrigger (64 again) and a note
+# still sounding at the end of the track, at 120 bpm (1/192 s per tick).
+# The note off of channel 1 at tick 48 must not end the note of channel 0
+NOTESONG=_song([[[0,_text(b'Notes')]],
+                [[0,bytearray([0x90,60,100])],[0,bytearray([0x90,64,90])],[48,bytearray([0x81,60,0])],
+                 [96,bytearray([0x80,60,0])],[96,bytearray([0x91,65,80])],[192,bytearray([0x90,64,70])],
+                 [288,bytearray([0x91,65,0])],[384,_text(b'End')]]])
+NOTES=[[60,100,0,0,1,0.,0.5],[64,90,0,0,1,0.,1.],[65,80,1,0,1,0.5,1.5],[64,70,0,0,1,1.,2.]]
+
+
+class notepairs(unittest.TestCase):
+
+    def test_times(self):
+        for options in [dict(),dict(lyricsonly=True)]:
+            m=midifile.midifile()
+            m.load_file(io.BytesIO(NOTESONG),**options)
+            self.assertEqual([list(note) for note in m.notes],NOTES)
+            self.assertEqual(m.duration,2.)
+        return
+
+
+class tempomaps(unittest.TestCase):
+
+    # 96 ticks per quarter note: 120 bpm until tick 192 (1 s), 240 bpm
+    # until tick 384 (1.5 s) and 60 bpm after that
+    TEMPOS=[[192,250000],[384,1000000],[0,500000]] # In any order
+    TICKS=[0,96,192,288,384,480]
+    SECONDS=[0.,0.5,1.,1.25,1.5,2.5]
+
+    def test_segments(self):
+        t=midifile.tempomap(96,self.TEMPOS)
+        self.assertEqual(t.ticks,[0,192,384])
+        for [tick,sec] in zip(self.TICKS,self.SECONDS):
+            self.assertAlmostEqual(t.tick2sec(tick),sec)
+            self.assertAlmostEqual(t.sec2tick(sec),tick)
+        for [value,sec] in zip(t.ticks2secs(self.TICKS),self.SECONDS):
+            self.assertAlmostEqual(value,sec)
+        return
+
+    def test_default(self):
+        self.assertAlmostEqual(midifile.tempomap(96).tick2sec(96),0.5) # 120 bpm
+        t=midifile.tempomap(96,[[0,500000],[0,1000000]]) # The last one at a tick
+        self.assertEqual(t.ticks,[0])
+        self.assertAlmostEqual(t.tick2sec(96),1.)
+        return
+
+
+class temposong(object):
+
+    def check(self,m):
+        # m has TEMPOSONG loaded
+        self.assertEqual(m.karsyl,['\\','La','la ','lo'])
+        self.assertEqual(m.kartimes,TEMPOTIMES)
+        self.assertEqual([list(note) for note in m.notes],TEMPONOTES)
+        return
+
+
+class tempotracks(temposong,unittest.TestCase):
+
+    # Tempo changes out of the conductor and lyric tracks must be used
+    # by every load mode
+
+    def test_full(self):
+        m=midifile.midifile()
+        m.load_file(io.BytesIO(TEMPOSONG))
+        self.check(m)
+        return
+
+    def test_lyricsonly(self):
+        m=midifile.midifile()
+        m.load_file(io.BytesIO(TEMPOSONG),lyricsonly=True)
+        self.assertEqual(m.kartimes,TEMPOTIMES) # Before the other tracks
+        self.check(m)
+        return
+
+    def test_background(self):
+        m=midifile.midifile()
+        m.load_file(io.BytesIO(TEMPOSONG),background=True)
+        self.assertEqual(m.kartimes,TEMPOTIMES)
+        self.assertTrue(m.wait_loaded())
+        self.check(m)
+        full=midifile.midifile()
+        full.load_file(io.BytesIO(TEMPOSONG))
+        self.assertEqual([m.notes,m.patchesused,m.duration],[full.notes,full.patchesused,full.duration])
+        return
+
+
+LINESONG=_song([[[0,_tempo(500000)]],
+                [[0,_text(b'@KMIDI KARAOKE FILE')]],
+                [[0,_text(b'\\Hel')],[96,_text(b'lo ')],[192,_text(b'world')],[288,_text(b'/Good')],
+                 [384,_text(b'bye')],[480,_text(b'\\Next')],[576,_text(b'page')]]])
+# Time, sung and pending part of each line of the page
+LINES=[[0.,['','',''],['Hello world','Goodbye','']],
+       [0.4,['Hel','',''],['lo world','Goodbye','']],
+       [0.6,['Hello ','',''],['world','Goodbye','']],
+       [1.1,['Hello world','',''],['','Goodbye','']],
+       [1.6,['Hello world','Good',''],['','bye','']],
+       [2.1,['','',''],['Nextpage','','']],
+       [2.6,['Next','',''],['page','','']],
+       [3.5,['Nextpage','',''],['','','']]]
+
+
+class playback(unittest.TestCase):
+
+    # A cursor of a read-only song must show the same karaoke lines as
+    # the midifile object it was made from, frame by frame and after a
+    # jump to any time
+
+    def setUp(self):
+        self.m=midifile.midifile()
+        self.m.load_file(io.BytesIO(benchmark.synthetic_song(notes=300,syllables=400)))
+        return
+
+    def lines(self,m):
+        return [list(m.karlinea),list(m.karlineb),m.karidx]
+
+    def test_cursor(self):
+        cursor=midifile.song(self.m).cursor()
+        self.m.seek_karaoke(0.)
+        t=0.
+        while t < self.m.duration+1.:
+            self.m.update_karaoke(t)
+            cursor.update_karaoke(t)
+            self.assertEqual(self.lines(cursor),self.lines(self.m))
+            t=t+0.05
+        return
+
+    def test_seek(self):
+        cursor=midifile.song(self.m).cursor()
+        self.m.seek_karaoke(0.)
+        t=0.
+        while t < self.m.duration+1.:
+            self.m.update_karaoke(t)
+            cursor.seek_karaoke(t)
+            self.assertEqual(self.lines(cursor),self.lines(self.m))
+            t=t+0.37
+        return
+
+    def test_known(self):
+        # Lines of a hand-made song (two pages, 0.5 s per syllable) by time
+        m=midifile.midifile()
+        m.load_file(io.BytesIO(LINESONG))
+        cursor=midifile.song(m).cursor()
+        for [t,linea,lineb] in LINES:
+            for player in [m,cursor]:
+                player.update_karaoke(t)
+                self.assertEqual([player.karlinea,player.karlineb],[linea,lineb])
+            cursor.seek_karaoke(t)
+            self.assertEqual([cursor.karlinea,cursor.karlineb],[linea,lineb])
+        return
+
+
+class badfiles(unittest.TestCase):
+
+    def setUp(self):
+        self.directory=tempfile.mkdtemp()
+        self.filein=os.path.join(self.directory,'garbage.kar')
+        f=open(self.filein,'wb')
+        f.write(b'garbage'*3)
+        f.close()
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        return
+
+    def test_not_midi(self):
+        self.assertRaises(ValueError,midifile.midifile().load_file,self.filein)
+        self.assertRaises(ValueError,midifile.midifile().load_file,self.filein,lyricsonly=True)
+        self.assertRaises(ValueError,list,midifile.midifile().iter_events(self.filein))
+        self.assertRaises(ValueError,midifile.midifile().write_file,self.filein,
+                          os.path.join(self.directory,'out.kar'),None,None)
+        return
+
+    def test_catalog(self):
+        # A broken file gets an error record and is not parsed again
+        # until it changes
+        catalogfile=os.path.join(self.directory,'catalog.json')
+        [records,report]=catalog.index_directory(self.directory,catalogfile,processes=1)
+        self.assertTrue('error' in records[0])
+        self.assertEqual([report['parsed'],report['failed']],[1,1])
+        [records,report]=catalog.index_directory(self.directory,catalogfile,processes=1)
+        self.assertEqual([report['parsed'],report['skipped'],report['failed']],[0,1,1])
+        return
+
+
+class lyrics(unittest.TestCase):
+
+    # Removing a song must leave the index as if it was never added
+
+    def song(self,data):
+        m=midifile.midifile()
+        m.load_file(io.BytesIO(data),lyricsonly=True)
+        return m
+
+    def test_remove(self):
+        other=self.song(benchmark.synthetic_song(notes=10,syllables=50))
+        expected=lyricindex.lyricindex()
+        expected.add_song('b.kar',other)
+        index=lyricindex.lyricindex()
+        index.add_song('a.kar',self.song(TEMPOSONG))
+        index.add_song('b.kar',other)
+        self.assertEqual(index.search('lala lo'),[['a.kar',0.]])
+        directory=tempfile.mkdtemp()
+        try:
+            filename=os.path.join(directory,'lyrics.json')
+            index.save(filename)
+            index=lyricindex.load_index(filename) # Words of each song rebuilt
+        finally:
+            shutil.rmtree(directory)
+        index.remove_song('a.kar')
+        self.assertEqual(index.search('lala lo'),[])
+        self.assertEqual([index.songs,index.songwords],[[None,'b.kar'],{1:expected.songwords[0]}])
+        self.assertEqual(sorted(index.postings),sorted(expected.postings))
+        return
+
+
+# A song in E flat major (3 flats) at 120 bpm, with a drum note (channel
+# index 9) between two notes of channel 0
+KEYSONG=_song([[[0,_tempo(500000)],[0,benchmark._meta(0x59,[0xFD,0])]],
+               [[0,bytearray([0x90,60,100])],[0,bytearray([0x99,36,100])],[96,bytearray([0x80,60,0])],
+                [96,bytearray([0x89,36,0])],[192,bytearray([0x90,62,100])],[384,bytearray([0x80,62,0])]]])
+
+
+class variants(unittest.TestCase):
+
+    def setUp(self):
+        self.directory=tempfile.mkdtemp()
+        self.filein=os.path.join(self.directory,'in.mid')
+        f=open(self.filein,'wb')
+        f.write(KEYSONG)
+        f.close()
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        return
+
+    def write(self,**options):
+        # Output of write_file, which must be the same as that of
+        # write_variant
+        fileout=os.path.join(self.directory,'out.mid')
+        midifile.midifile().write_file(self.filein,fileout,None,None,**options)
+        f=open(fileout,'rb')
+        data=f.read()
+        f.close()
+        m=midifile.midifile()
+        m.load_file(self.filein,keepevents=True)
+        out=io.BytesIO()
+        m.write_variant(out,**options)
+        self.assertEqual(out.getvalue(),data)
+        m=midifile.midifile()
+        m.load_file(io.BytesIO(data))
+        return [data,m]
+
+    def notes(self,m):
+        return [[note[0],note[2],note[5],note[6]] for note in m.notes]
+
+    def test_transpose(self):
+        [data,m]=self.write(transpose=3)
+        self.assertEqual(self.notes(m),[[63,0,0.,0.5],[36,9,0.,0.5],[65,0,1.,2.]])
+        self.assertTrue(b'\xFF\x59\x02\x06\x00' in data) # F sharp major
+        [data,m]=self.write(transpose=-3)
+        self.assertEqual(self.notes(m),[[57,0,0.,0.5],[36,9,0.,0.5],[59,0,1.,2.]])
+        self.assertTrue(b'\xFF\x59\x02\x00\x00' in data) # C major
+        return
+
+    def test_tempo(self):
+        [data,m]=self.write(tempo=2.)
+        self.assertEqual(m.microsecondsperquarternote[-1],[250000.,0.])
+        self.assertEqual(self.notes(m),[[60,0,0.,0.25],[36,9,0.,0.25],[62,0,0.5,1.]])
+        return
+
+    def test_cut(self):
+        # From tick 48 to 288: the notes started before t0 are left out
+        # and the one sounding at t1 is switched off there
+        [data,m]=self.write(t0=0.25,t1=1.5)
+        self.assertEqual(self.notes(m),[[62,0,0.75,1.25]])
+        self.assertEqual(m.duration,1.25)
+        return
+
+
+class duplicates(unittest.TestCase):
+
+    # Copies played at another tempo or in another key must have a melody
+    # signature similar to that of the original
+
+    def setUp(self):
+        self.directory=tempfile.mkdtemp()
+        self.filein=os.path.join(self.directory,'in.kar')
+        f=open(self.filein,'wb')
+        f.write(benchmark.synthetic_song(notes=200))
+        f.close()
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        return
+
+    def notes(self,filename):
+        return {'notes':fingerprint.fingerprint_file(filename)['notes']}
+
+    def test_variants(self):
+        original=self.notes(self.filein)
+        fileout=os.path.join(self.directory,'out.kar')
+        for options in [dict(tempo=0.8),dict(tempo=1.3),dict(transpose=3)]:
+            midifile.midifile().write_file(self.filein,fileout,None,None,**options)
+            self.assertTrue(fingerprint.similarity(original,self.notes(fileout)) >= 0.5,options)
+        return
+
+
+class bigfiles(unittest.TestCase):
+
+    # Files of at least midifile.MMAPSIZE bytes are memory-mapped. The
+    # limit is lowered so that a small song takes that path
+
+    def setUp(self):
+        self.directory=tempfile.mkdtemp()
+        self.filein=os.path.join(self.directory,'in.kar')
+        self.fileout=os.path.join(self.directory,'out.kar')
+        f=open(self.filein,'wb')
+        f.write(benchmark.synthetic_song(notes=300))
+        f.close()
+        self.mmapsize=midifile.MMAPSIZE
+        midifile.MMAPSIZE=0
+        return
+
+    def tearDown(self):
+        midifile.MMAPSIZE=self.mmapsize
+        shutil.rmtree(self.directory)
+        return
+
+    def read(self,filename):
+        f=open(filename,'rb')
+        data=f.read()
+        f.close()
+        return data
+
+    def test_write_file(self):
+        for options in [dict(),dict(patches2remove=[0,1]),dict(transpose=2,tempo=1.2),dict(t0=1.,t1=5.)]:
+            tracks2remove=[3]
+            patches2remove=options.pop('patches2remove',None)
+            midifile.midifile().write_file(self.filein,self.fileout,tracks2remove,patches2remove,**options)
+            midifile.MMAPSIZE=self.mmapsize # Same output without mmap
+            expected=os.path.join(self.directory,'expected.kar')
+            midifile.midifile().write_file(self.filein,expected,tracks2remove,patches2remove,**options)
+            midifile.MMAPSIZE=0
+            self.assertEqual(self.read(self.fileout),self.read(expected))
+        return
+
+    def test_iter_events(self):
+        events=list(midifile.midifile().iter_events(self.filein))
+        midifile.MMAPSIZE=self.mmapsize
+        self.assertEqual(events,list(midifile.midifile().iter_events(self.filein)))
+        midifile.MMAPSIZE=0
+        generator=midifile.midifile().iter_events(self.filein)
+        self.assertEqual(next(generator),events[0])
+        generator.close() # Stopped early
+        return
+
+    def mapped(self):
+        f=open(self.filein,'rb')
+        song=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        f.close()
+        return song
+
+    def test_mmap_objects(self):
+        # An mmap object is parsed in place and left open
+        midifile.MMAPSIZE=self.mmapsize
+        song=self.mapped()
+        m=midifile.midifile()
+        m.load_file(song)
+        self.assertEqual(song.size(),os.path.getsize(self.filein))
+        song.close()
+        expected=midifile.midifile()
+        expected.load_file(self.filein)
+        self.assertEqual([m.notes,m.karsyl],[expected.notes,expected.karsyl])
+        midifile.midifile().write_file(self.mapped(),self.fileout,[3],None,transpose=2)
+        expectedout=os.path.join(self.directory,'expected.kar')
+        midifile.midifile().write_file(self.filein,expectedout,[3],None,transpose=2)
+        self.assertEqual(self.read(self.fileout),self.read(expectedout))
+        self.assertEqual(list(midifile.midifile().iter_events(self.mapped())),
+                         list(midifile.midifile().iter_events(self.filein)))
+        return
+
+
+class songpacks(temposong,unittest.TestCase):
+
+    # Songs are parsed from slices of the map of the pack, which can be
+    # closed while a song still has tracks to decode
+
+    def setUp(self):
+        self.directory=tempfile.mkdtemp()
+        self.filename=os.path.join(self.directory,'test.songs')
+        self.songs=[['a.kar',TEMPOSONG],['b.kar',bytes(benchmark.synthetic_song(notes=100))]]
+        songpack.write_pack(self.filename,self.songs)
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        return
+
+    def test_load(self):
+        pack=songpack.songpack(self.filename)
+        self.assertEqual(pack.names,['a.kar','b.kar'])
+        songs=list()
+        for [name,data] in self.songs:
+            self.assertEqual(pack.read(name),data)
+            songs.append(pack.load(name,lyricsonly=True))
+        pack.close()
+        self.check(songs[0])
+        expected=midifile.midifile()
+        expected.load_file(io.BytesIO(self.songs[1][1]))
+        self.assertEqual([songs[1].karsyl,songs[1].kartimes,songs[1].notes],
+                         [expected.karsyl,expected.kartimes,expected.notes])
+        return
+
+    def test_slices(self):
+        # The karaoke and tempo tracks are found in a slice of a buffer
+        data=b'garbage'+TEMPOSONG+b'garbage'
+        m=midifile.midifile()
+        m.load_file(memoryview(data)[7:7+len(TEMPOSONG)],lyricsonly=True)
+        self.check(m)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()